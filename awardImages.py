@@ -0,0 +1,106 @@
+import hashlib
+import io
+import os
+import re
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Content-addressed store for mirrored award images. Files are named by the
+# SHA-256 of their bytes, so an image linked from several awards or downloaded
+# again is stored once, and a name always means the same bytes. That is what
+# lets the API serve them with an immutable, year-long Cache-Control.
+#     store = ImageStore()
+#     name = store.put(data)              # "3f2a...c1.gif"
+#     store.thumbnail(name, "ribbon")     # "3f2a...c1_64x24.png", needs Pillow
+# The API serves a thumbnail as /images/<name>?size=<kind> once it has been made.
+IMAGE_DIR = "award_images"
+
+# Bounding boxes for the optional thumbnails, by the kind of award image they shrink
+THUMBNAIL_SIZES = {
+    "presentation": (128, 128),
+    "ribbon": (64, 24),
+}
+
+IMAGE_TYPES = {
+    "gif": "image/gif",
+    "png": "image/png",
+    "jpg": "image/jpeg",
+    "webp": "image/webp",
+}
+
+NAME_PATTERN = re.compile(r"^[0-9a-f]{64}(?:_\d+x\d+)?\.(?:gif|png|jpg|webp)$")
+
+
+def sniff_image_type(data):
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "png"
+    if data[:3] == b"\xff\xd8\xff":
+        return "jpg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+class ImageStore:
+    def __init__(self, directory=IMAGE_DIR):
+        # Absolute, so paths mean the same file whatever directory a server resolves them against
+        self.directory = os.path.abspath(directory)
+
+    def path(self, name):
+        # Only names this store hands out are accepted, so request paths cannot escape the directory
+        if not NAME_PATTERN.match(name):
+            return None
+        return os.path.join(self.directory, name[:2], name)
+
+    def content_type(self, name):
+        return IMAGE_TYPES[name.rsplit(".", 1)[1]]
+
+    def exists(self, name):
+        path = self.path(name)
+        return path is not None and os.path.exists(path)
+
+    def _write(self, name, data):
+        path = self.path(name)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Unique temporary name so concurrent writers of the same image never interleave
+        tmp_path = f"{path}.{os.getpid()}.{id(data)}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def put(self, data):
+        # Returns the stored name, or None when data is not an image (an error page, say)
+        image_type = sniff_image_type(data)
+        if image_type is None:
+            return None
+        name = f"{hashlib.sha256(data).hexdigest()}.{image_type}"
+        self._write(name, data)
+        return name
+
+    def thumbnail_name(self, name, kind):
+        width, height = THUMBNAIL_SIZES[kind]
+        return f"{name.rsplit('.', 1)[0]}_{width}x{height}.png"
+
+    def thumbnail(self, name, kind):
+        # Returns the thumbnail's name, or None without Pillow
+        if Image is None:
+            return None
+        width, height = THUMBNAIL_SIZES[kind]
+        thumbnail_name = self.thumbnail_name(name, kind)
+        if self.exists(thumbnail_name):
+            return thumbnail_name
+        with Image.open(self.path(name)) as image:
+            image.seek(0)  # first frame of animated GIFs
+            image = image.convert("RGBA")
+            image.thumbnail((width, height))
+            out = io.BytesIO()
+            image.save(out, "PNG", optimize=True)
+        self._write(thumbnail_name, out.getvalue())
+        return thumbnail_name
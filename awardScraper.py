@@ -0,0 +1,286 @@
+import hashlib
+import json
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+
+import requests
+from bs4 import BeautifulSoup, SoupStrainer
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from awardImages import ImageStore
+
+# Scrapes the award catalog from the 29th website.
+#     fetcher = Fetcher()
+#     awards = scrape_awards(fetcher)
+# Responses are cached on disk with their ETag / Last-Modified, so a rerun
+# sends conditional requests and an unchanged page costs a 304, not a
+# download. base_url and session can be pointed at a local stand-in server.
+BASE_URL = "https://www.29th.org"
+AWARDS_PATH = "/about/awards"
+CACHE_DIR = ".scraper_cache"
+
+# Field order matches the awards table, so records go straight to create_awards_bulk
+AwardInfo = namedtuple("AwardInfo", ["award_name", "award_description", "award_image_bg", "award_image_sm"])
+
+
+def make_session(pool_size=8, retries=3, backoff=0.5):
+    retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=("GET", "HEAD"))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["User-Agent"] = "29th-award-scraper"
+    return session
+
+
+class ResponseCache:
+    # One body file plus one JSON file of validators per URL, named by the URL's hash
+    def __init__(self, directory=CACHE_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _paths(self, url):
+        key = hashlib.sha256(url.encode()).hexdigest()
+        base = os.path.join(self.directory, key)
+        return base + ".body", base + ".json"
+
+    def get(self, url):
+        body_path, meta_path = self._paths(url)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            with open(body_path, "rb") as f:
+                return meta, f.read()
+        except (OSError, ValueError):
+            return None, None
+
+    def validators(self, url):
+        meta, _ = self.get(url)
+        headers = {}
+        if meta:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+        return headers
+
+    def store(self, url, response):
+        body_path, meta_path = self._paths(url)
+        meta = {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "content_type": response.headers.get("Content-Type"),
+        }
+        # Write to temporary names first so a crash never leaves a body without its validators
+        for path, data, mode in ((body_path, response.content, "wb"), (meta_path, json.dumps(meta), "w")):
+            with open(path + ".tmp", mode) as f:
+                f.write(data)
+            os.replace(path + ".tmp", path)
+
+
+class Fetcher:
+    def __init__(self, base_url=BASE_URL, session=None, cache=None, workers=8, timeout=10.0):
+        self.base_url = base_url.rstrip("/")
+        self.session = session or make_session(pool_size=workers)
+        self.cache = cache or ResponseCache()
+        self.workers = workers
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.stats = {"downloaded": 0, "not_modified": 0}
+
+    def url(self, path_or_url):
+        if path_or_url.startswith(("http://", "https://")):
+            return path_or_url
+        return self.base_url + path_or_url
+
+    def fetch(self, path_or_url):
+        url = self.url(path_or_url)
+        response = self.session.get(url, headers=self.cache.validators(url), timeout=self.timeout)
+        if response.status_code == 304:
+            _, body = self.cache.get(url)
+            if body is not None:
+                with self.lock:
+                    self.stats["not_modified"] += 1
+                return body
+            # The cache lost the body; ask again without validators
+            response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        self.cache.store(url, response)
+        with self.lock:
+            self.stats["downloaded"] += 1
+        return response.content
+
+    def fetch_many(self, urls):
+        # Returns {url: body or exception}; one failed image does not lose the rest
+        def one(url):
+            try:
+                return url, self.fetch(url)
+            except requests.RequestException as e:
+                return url, e
+
+        urls = list(dict.fromkeys(url for url in urls if url))
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            return dict(pool.map(one, urls))
+
+    def close(self):
+        self.session.close()
+
+
+# Get the content of the website
+def get_website_response(fetcher=None):
+    fetcher = fetcher or Fetcher()
+    try:
+        return fetcher.fetch(AWARDS_PATH).decode("utf-8")
+    except requests.RequestException as e:
+        print(f"Failed to retrieve website: {e}")
+        return None
+
+
+class AwardBlockParser(HTMLParser):
+    # Single pass over the page with the stdlib tokenizer. No tree is built;
+    # only text and images inside div.media.mb-4 blocks are kept.
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.awards = []
+        self.depth = 0  # div nesting inside the current block, 0 when outside
+        self.body_depth = None
+        self.images_depth = None
+        self.in_title = False
+        self.title = []
+        self.description = []
+        self.images = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "div":
+            classes = set((dict(attrs).get("class") or "").split())
+            if self.depth:
+                self.depth += 1
+                if "media-body" in classes and self.body_depth is None:
+                    self.body_depth = self.depth
+                elif "award-images" in classes and self.images_depth is None:
+                    self.images_depth = self.depth
+            elif {"media", "mb-4"} <= classes:
+                self.depth = 1
+        elif not self.depth:
+            return
+        elif tag == "h5" and "mt-0" in (dict(attrs).get("class") or "").split():
+            self.in_title = True
+        elif tag == "img" and self.images_depth is not None:
+            self.images.append(dict(attrs).get("src"))
+
+    def handle_endtag(self, tag):
+        if not self.depth:
+            return
+        if tag == "h5":
+            self.in_title = False
+        elif tag == "div":
+            if self.depth == self.body_depth:
+                self.body_depth = None
+            elif self.depth == self.images_depth:
+                self.images_depth = None
+            self.depth -= 1
+            if not self.depth:
+                self._end_block()
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.title.append(data)
+        elif self.body_depth is not None:
+            self.description.append(data)
+
+    def _end_block(self):
+        if self.title:
+            self.awards.append(AwardInfo("".join(self.title), "".join(self.description).strip(),
+                                         self.images[0] if len(self.images) > 0 else None,
+                                         self.images[1] if len(self.images) > 1 else None))
+        self.body_depth = self.images_depth = None
+        self.in_title = False
+        self.title, self.description, self.images = [], [], []
+
+
+def _award_from_block(info):
+    title = info.find("h5", attrs={"class": "mt-0"})
+    if not title:
+        return None
+    text = info.find("div", attrs={"class": "media-body"})
+    image_block = info.find("div", attrs={"class": "award-images"})
+    images = image_block.find_all("img") if image_block else []
+
+    # Assuming the first image is the 'presentation image' and the second is the 'ribbon image'
+    img_big = images[0]['src'] if len(images) > 0 else None
+    img_sm = images[1]['src'] if len(images) > 1 else None
+    text_content = text.text.replace(title.text, "").strip() if text else ""
+    return AwardInfo(title.text, text_content, img_big, img_sm)
+
+
+def _soup_awards(html_content, features, parse_only=None):
+    soup = BeautifulSoup(html_content, features, parse_only=parse_only)
+    blocks = soup.find_all("div", attrs={"class": "media mb-4"})
+    return [award for award in map(_award_from_block, blocks) if award]
+
+
+def _single_pass_awards(html_content):
+    parser = AwardBlockParser()
+    parser.feed(html_content)
+    parser.close()
+    return parser.awards
+
+
+AWARD_BLOCKS = SoupStrainer("div", attrs={"class": "media mb-4"})
+
+# "fast" is the single-pass extractor. It leaves the title element out of the
+# description, where the soup parsers strip the title text from the whole body.
+AWARD_PARSERS = {
+    "fast": _single_pass_awards,
+    "html.parser": lambda html_content: _soup_awards(html_content, "html.parser"),
+    "strainer": lambda html_content: _soup_awards(html_content, "html.parser", AWARD_BLOCKS),
+    "lxml": lambda html_content: _soup_awards(html_content, "lxml"),
+    "lxml-strainer": lambda html_content: _soup_awards(html_content, "lxml", AWARD_BLOCKS),
+}
+
+
+# Extract the award info as AwardInfo records
+def award_info(html_content, parser="fast"):
+    if parser not in AWARD_PARSERS:
+        raise ValueError(f"Unknown award parser {parser!r}, expected one of {', '.join(AWARD_PARSERS)}")
+    return AWARD_PARSERS[parser](html_content)
+
+
+def scrape_awards(fetcher=None, parser="fast"):
+    fetcher = fetcher or Fetcher()
+    website_content = get_website_response(fetcher)
+    if not website_content:  # Ensure the website content was fetched successfully
+        return []
+    return award_info(website_content, parser)
+
+
+def mirror_award_images(awards, fetcher=None, store=None, thumbnails=False):
+    # Downloads every award image in parallel into the content-addressed store
+    # and returns {remote url: stored name} for MilitaryDatabase.record_award_images
+    fetcher = fetcher or Fetcher()
+    store = store or ImageStore()
+    kinds = {}
+    for award in awards:
+        for url, kind in ((award.award_image_bg, "presentation"), (award.award_image_sm, "ribbon")):
+            if url:
+                kinds.setdefault(url, kind)
+
+    mirrored = {}
+    for url, result in fetcher.fetch_many(kinds).items():
+        if isinstance(result, Exception):
+            print(f"Failed to fetch {url}: {result}")
+            continue
+        name = store.put(result)
+        if name is None:
+            print(f"Not an image: {url}")
+            continue
+        if thumbnails:
+            store.thumbnail(name, kinds[url])
+        mirrored[url] = name
+    return mirrored
@@ -1,17 +1,77 @@
-from flask import Flask, request, jsonify, g
+import functools
+import threading
+
+from flask import Flask, request, jsonify, g, Response, stream_with_context, make_response, send_file
 from flask_cors import CORS
-from mdbTests import MilitaryDatabase
+import dbApiCommon as api
+import dbJson
+from mdbTests import MilitaryDatabase, get_query_cache
 
+# Flask (WSGI) front end. The route logic lives in dbApiCommon and is shared
+# with the ASGI app in dbApiAsync.
 app = Flask(__name__)
 CORS(app)
+api.configure(app.config)
+
+pool_lock = threading.Lock()
+
+
+def get_pools():
+    with pool_lock:
+        pools = app.extensions.get('db_pools')
+        if pools is None:
+            pools = api.open_pools(app.config)
+            app.extensions['db_pools'] = pools
+        return pools
+
+
+def open_db():
+    writer, readers = get_pools()
+    return MilitaryDatabase(app.config['DATABASE'], pool=writer, read_pool=readers)
 
 
 def get_db():
     if 'db' not in g:
-        g.db = MilitaryDatabase('29awards.db')
+        g.db = open_db()
     return g.db
 
 
+def conditional(view):
+    # Answers If-None-Match with 304 before the view (and its queries) runs
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        version = get_db().get_data_version()
+        if version is None:
+            return view(*args, **kwargs)
+        etag = api.etag(version, request.full_path)
+        if request.if_none_match.contains_weak(etag):
+            response = make_response('', 304)
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag, weak=True)
+        return response
+    return wrapper
+
+
+def route_serializer_name():
+    return api.serializer_name(app.config, request.endpoint)
+
+
+def route_serializer():
+    return dbJson.get_serializer(route_serializer_name())
+
+
+def respond(result):
+    data, status = result
+    if data is None:
+        return Response(status=status)
+    if isinstance(data, api.RawJson):
+        return Response(data, status=status, mimetype='application/json')
+    return Response(route_serializer()(data), status=status, mimetype='application/json')
+
+
 @app.teardown_appcontext
 def close_db(exception=None):
     db = g.pop('db', None)
@@ -19,157 +79,194 @@ def close_db(exception=None):
         db.close()
 
 
+@app.route('/poolstats', methods=['GET'])
+def get_pool_stats():
+    return jsonify(api.pool_metrics(get_pools()))
+
+
+@app.route('/cachestats', methods=['GET'])
+def get_cache_stats():
+    return jsonify(get_query_cache(app.config['DATABASE']).metrics())
+
+
 @app.route('/soldiers', methods=['GET'])
+@conditional
 def get_all_soldiers():
-    db = get_db()
-    soldiers = db.retrieve_all_soldiers()
-    return jsonify(soldiers)
+    stream = request.args.get('stream')
+    if stream == 'ndjson':
+        return Response(stream_with_context(stream_soldiers_ndjson()), mimetype='application/x-ndjson')
+    if stream == 'json':
+        return Response(stream_with_context(stream_soldiers_json()), mimetype='application/json')
+    return respond(api.soldiers(get_db(), request.args, app.config))
+
+
+def iter_soldiers():
+    # The request's db is closed at teardown, before the body is sent, so a
+    # stream reads through its own and gives the connection back when it ends
+    db = open_db()
+    try:
+        yield from db.iter_soldiers()
+    finally:
+        db.close()
+
+
+def stream_soldiers_ndjson():
+    dumps = route_serializer()
+    for row in iter_soldiers():
+        yield dumps(row) + b'\n'
+
+
+def stream_soldiers_json():
+    dumps = route_serializer()
+    yield b'['
+    first = True
+    for row in iter_soldiers():
+        if first:
+            first = False
+            yield dumps(row)
+        else:
+            yield b',' + dumps(row)
+    yield b']'
+
+
+@app.route('/search', methods=['GET'])
+@conditional
+def search_soldiers():
+    return respond(api.search_soldiers(get_db(), request.args, app.config))
 
 
 @app.route('/units/<int:parent_unit_id>', methods=['GET'])
+@conditional
 def get_units_by_parent(parent_unit_id):
-    db = get_db()
-    units = db.retrieve_units_by_parent(parent_unit_id)
-    return jsonify(units)
+    return respond(api.units_by_parent(get_db(), parent_unit_id))
+
+
+@app.route('/units/<int:unit_id>/tree', methods=['GET'])
+@conditional
+def get_unit_tree(unit_id):
+    return respond(api.unit_tree(get_db(), unit_id, request.args))
 
-@app.route('/allunitsandsoldiers', methods=['GET'])
-def get_all_units_and_soldiers():
-    db = get_db()
-    units = db.retrieve_all_units()
 
-    # For each unit, get the soldiers assigned to it
-    for unit in units:
-        unit_id = unit['id']
-        unit['soldiers'] = db.get_soldiers_by_unit(unit_id)
+@app.route('/units/<int:unit_id>/ancestors', methods=['GET'])
+@conditional
+def get_unit_ancestors(unit_id):
+    return respond(api.unit_ancestors(get_db(), unit_id))
 
-    return jsonify(units)
+
+@app.route('/units/<int:unit_id>/allsoldiers', methods=['GET'])
+@conditional
+def get_soldiers_under_unit(unit_id):
+    return respond(api.soldiers_under_unit(get_db(), unit_id))
+
+
+@app.route('/units/<int:unit_id>/stats', methods=['GET'])
+@conditional
+def get_unit_stats(unit_id):
+    return respond(api.unit_stats(get_db(), unit_id))
+
+
+@app.route('/units/<int:unit_id>/move', methods=['POST'])
+def move_unit(unit_id):
+    return respond(api.move_unit(get_db(), unit_id, request.get_json()))
+
+
+@app.route('/allunitsandsoldiers', methods=['GET'])
+@conditional
+def get_all_units_and_soldiers():
+    return respond(api.units_with_soldiers(get_db()))
 
 
 @app.route('/soldier', methods=['POST'])
 def add_soldier():
-    db = get_db()
-    data = request.get_json()
-    soldier_id = db.add_soldier(data['name'], data['age'], data['address'], data['rank'], data['ait'], data['unit_id'])
-    return jsonify({'id': soldier_id}), 201
+    return respond(api.add_soldier(get_db(), request.get_json()))
 
 
 @app.route('/soldier', methods=['GET'])
 def remove_soldier():
-    db = get_db()
-    data = request.get_json()
-    db.remove_soldier(data['id'])
-    return '', 204
+    return respond(api.remove_soldier(get_db(), request.get_json()))
 
 
 @app.route('/soldiers/<int:unit_id>', methods=['GET'])
+@conditional
 def get_soldiers_by_unit(unit_id):
-    db = get_db()
-    soldiers = db.get_soldiers_by_unit(unit_id)
-    return jsonify(soldiers)
+    return respond(api.soldiers_by_unit(get_db(), unit_id))
 
 
 @app.route('/addunit', methods=['POST'])
 def add_unit():
-    db = get_db()
-    data = request.get_json()
-    unit_id = db.add_unit(data['name'], data['type'], data['image'], data.get('parent_unit_id'))
-    return jsonify({'id': unit_id}), 201
+    return respond(api.add_unit(get_db(), request.get_json()))
 
 
 @app.route('/assign', methods=['POST'])
 def assign_soldier_to_unit():
-    db = get_db()
-    data = request.get_json()
-    db.assign_soldier_to_unit(data['soldier_id'], data['unit_id'])
-    return '', 204
+    return respond(api.assign_soldier_to_unit(get_db(), request.get_json()))
 
 
 @app.route('/units', methods=['GET'])
+@conditional
 def get_all_units():
-    db = get_db()
-    units = db.retrieve_all_units()
-    return jsonify(units)
+    return respond(api.all_units(get_db()))
 
 
 @app.route('/addaward/<int:soldier_id>/<int:award_id>', methods=['GET'])
 def add_award(soldier_id, award_id):
-    db = get_db()
-    db.add_award_to_soldier(soldier_id, award_id)
-    return f'Award added for {soldier_id}', 204
+    return respond(api.add_award(get_db(), soldier_id, award_id))
 
 
 @app.route('/removeaward/<int:soldier_id>/<int:award_id>', methods=['GET'])
 def remove_award(soldier_id, award_id):
-    db = get_db()
-    db.remove_award_from_soldier(soldier_id, award_id)
-    return f'Award removed for {soldier_id}', 204
+    return respond(api.remove_award(get_db(), soldier_id, award_id))
+
+
+@app.route('/awards/grant', methods=['POST'])
+def grant_awards():
+    return respond(api.grant_awards(get_db(), request.get_json(silent=True), app.config))
 
 
 @app.route('/getawards/<int:soldier_id>', methods=['GET'])
+@conditional
 def get_award_by_solider(soldier_id):
-    db = get_db()
-    return jsonify(db.get_awards_by_soldier(soldier_id))
+    return respond(api.awards_by_soldier(get_db(), soldier_id))
 
 
 @app.route('/getallawards', methods=['GET'])
+@conditional
 def get_all_awards():
-    db = get_db()
-    units = db.get_all_awards()
-    return jsonify(units)
+    return respond(api.all_awards(get_db()))
+
+
+@app.route('/images/<name>', methods=['GET'])
+def get_award_image(name):
+    image = api.image_file(app.config, name, request.args.get('size'))
+    if image is None:
+        return respond(api.error('Image not found', 404))
+    name, path, mimetype = image
+    response = send_file(path, mimetype=mimetype, etag=name, max_age=app.config['IMAGE_MAX_AGE'])
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
 
 
 @app.route('/adddemerit/<int:soldier_id>', methods=['POST'])
 def add_demerit(soldier_id):
-    db = get_db()
-    data = request.get_json()
-    demerit_name = data.get('demerit_name')
-    demerit_description = data.get('demerit_description', None)
-    demerit_signature = data.get('demerit_signature', None)
-    db.add_demerit_to_soldier(soldier_id, demerit_name, demerit_description, demerit_signature)
+    return respond(api.add_demerit(get_db(), soldier_id, request.get_json(silent=True)))
+
 
-    return f'Demerit has ben added to {soldier_id}', 204
+@app.route('/demerits/batch', methods=['POST'])
+def add_demerits_batch():
+    return respond(api.add_demerits_batch(get_db(), request.get_json(silent=True), app.config))
 
 
 @app.route('/demerits', methods=['GET'])
+@conditional
 def get_all_demerits():
-    db = get_db()
-
-    demerits_data = db.get_all_soldier_demerits()
-
-    response = []
-    for row in demerits_data:
-        response.append({
-            'soldier_id': row[0],
-            'soldier_name': row[1],
-            'demerit_id': row[2],
-            'demerit_name': row[3],
-            'demerit_description': row[4],
-            'demerit_signature': row[5]
-        })
-
-    return jsonify(response)
+    return respond(api.all_demerits(get_db(), route_serializer_name() == dbJson.SQLITE))
 
 
 @app.route('/demerits/<int:soldier_id>', methods=['GET'])
+@conditional
 def get_soldier_demerits(soldier_id):
-    db = get_db()
-
-    # Fetching demerits for the specified soldier
-    demerits_data = db.get_demerits_for_soldier(soldier_id)
-
-    # Creating a list of dictionaries for the response
-    response = []
-    for row in demerits_data:
-        response.append({
-            'soldier_id': row[0],
-            'soldier_name': row[1],
-            'demerit_id': row[2],
-            'demerit_name': row[3],
-            'demerit_description': row[4],
-            'demerit_signature': row[5]
-        })
-
-    return jsonify(response)
+    return respond(api.soldier_demerits(get_db(), soldier_id, route_serializer_name() == dbJson.SQLITE))
 
 
 if __name__ == '__main__':
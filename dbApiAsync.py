@@ -0,0 +1,282 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from quart import Quart, request, jsonify, make_response, Response, send_file
+from quart_cors import cors
+import dbApiCommon as api
+import dbJson
+from mdbTests import MilitaryDatabase, get_query_cache
+
+# ASGI version of dbApi with the same routes. Run it with
+#     hypercorn dbApiAsync:app --bind 127.0.0.1:5001
+# sqlite3 calls are handed to a bounded thread pool, so a slow client only
+# costs a coroutine while the database threads stay busy with queries.
+app = Quart(__name__)
+app = cors(app)
+api.configure(app.config)
+app.config.setdefault('DB_EXECUTOR_WORKERS', 9)
+app.config.setdefault('SOLDIERS_STREAM_BATCH', 500)
+
+
+@app.before_serving
+async def open_db():
+    app.extensions['db_pools'] = api.open_pools(app.config)
+    app.extensions['db_executor'] = ThreadPoolExecutor(max_workers=app.config['DB_EXECUTOR_WORKERS'],
+                                                       thread_name_prefix='db')
+
+
+@app.after_serving
+async def close_db():
+    app.extensions.pop('db_executor').shutdown(wait=True)
+    for pool in app.extensions.pop('db_pools'):
+        pool.close()
+
+
+def call_db(fn, *args, **kwargs):
+    # Runs on an executor thread and only holds pooled connections for the one call
+    writer, readers = app.extensions['db_pools']
+    db = MilitaryDatabase(app.config['DATABASE'], pool=writer, read_pool=readers)
+    try:
+        return fn(db, *args, **kwargs)
+    finally:
+        db.close()
+
+
+async def run_db(fn, *args, **kwargs):
+    # fn is a MilitaryDatabase method or a dbApiCommon handler; either takes the db first
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(app.extensions['db_executor'],
+                                      functools.partial(call_db, fn, *args, **kwargs))
+
+
+def conditional(view):
+    @functools.wraps(view)
+    async def wrapper(*args, **kwargs):
+        version = await run_db(MilitaryDatabase.get_data_version)
+        if version is None:
+            return await view(*args, **kwargs)
+        etag = api.etag(version, request.full_path)
+        if request.if_none_match.contains_weak(etag):
+            response = await make_response('', 304)
+        else:
+            response = await make_response(await view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag, weak=True)
+        return response
+    return wrapper
+
+
+def route_serializer_name():
+    return api.serializer_name(app.config, request.endpoint)
+
+
+def route_serializer():
+    return dbJson.get_serializer(route_serializer_name())
+
+
+def respond(result):
+    data, status = result
+    if data is None:
+        return Response('', status=status)
+    if isinstance(data, api.RawJson):
+        return Response(data, status=status, mimetype='application/json')
+    return Response(route_serializer()(data), status=status, mimetype='application/json')
+
+
+@app.route('/poolstats', methods=['GET'])
+async def get_pool_stats():
+    return jsonify(api.pool_metrics(app.extensions['db_pools']))
+
+
+@app.route('/cachestats', methods=['GET'])
+async def get_cache_stats():
+    return jsonify(get_query_cache(app.config['DATABASE']).metrics())
+
+
+@app.route('/soldiers', methods=['GET'])
+@conditional
+async def get_all_soldiers():
+    stream = request.args.get('stream')
+    if stream == 'ndjson':
+        return stream_soldiers_ndjson(route_serializer()), 200, {'Content-Type': 'application/x-ndjson'}
+    if stream == 'json':
+        return stream_soldiers_json(route_serializer()), 200, {'Content-Type': 'application/json'}
+    return respond(await run_db(api.soldiers, request.args, app.config))
+
+
+async def iter_soldier_pages():
+    # Keyset pages keep a cursor from being held open across awaits
+    batch = app.config['SOLDIERS_STREAM_BATCH']
+    cursor = 0
+    while True:
+        rows = await run_db(MilitaryDatabase.retrieve_soldiers_page, cursor, batch)
+        if rows:
+            yield rows
+        if len(rows) < batch:
+            break
+        cursor = rows[-1][0]
+
+
+async def stream_soldiers_ndjson(dumps):
+    async for rows in iter_soldier_pages():
+        yield b''.join(dumps(row) + b'\n' for row in rows)
+
+
+async def stream_soldiers_json(dumps):
+    yield b'['
+    first = True
+    async for rows in iter_soldier_pages():
+        chunk = b','.join(dumps(row) for row in rows)
+        if first:
+            first = False
+            yield chunk
+        else:
+            yield b',' + chunk
+    yield b']'
+
+
+@app.route('/search', methods=['GET'])
+@conditional
+async def search_soldiers():
+    return respond(await run_db(api.search_soldiers, request.args, app.config))
+
+
+@app.route('/units/<int:parent_unit_id>', methods=['GET'])
+@conditional
+async def get_units_by_parent(parent_unit_id):
+    return respond(await run_db(api.units_by_parent, parent_unit_id))
+
+
+@app.route('/units/<int:unit_id>/tree', methods=['GET'])
+@conditional
+async def get_unit_tree(unit_id):
+    return respond(await run_db(api.unit_tree, unit_id, request.args))
+
+
+@app.route('/units/<int:unit_id>/ancestors', methods=['GET'])
+@conditional
+async def get_unit_ancestors(unit_id):
+    return respond(await run_db(api.unit_ancestors, unit_id))
+
+
+@app.route('/units/<int:unit_id>/allsoldiers', methods=['GET'])
+@conditional
+async def get_soldiers_under_unit(unit_id):
+    return respond(await run_db(api.soldiers_under_unit, unit_id))
+
+
+@app.route('/units/<int:unit_id>/stats', methods=['GET'])
+@conditional
+async def get_unit_stats(unit_id):
+    return respond(await run_db(api.unit_stats, unit_id))
+
+
+@app.route('/units/<int:unit_id>/move', methods=['POST'])
+async def move_unit(unit_id):
+    return respond(await run_db(api.move_unit, unit_id, await request.get_json()))
+
+
+@app.route('/allunitsandsoldiers', methods=['GET'])
+@conditional
+async def get_all_units_and_soldiers():
+    return respond(await run_db(api.units_with_soldiers))
+
+
+@app.route('/soldier', methods=['POST'])
+async def add_soldier():
+    return respond(await run_db(api.add_soldier, await request.get_json()))
+
+
+@app.route('/soldier', methods=['GET'])
+async def remove_soldier():
+    return respond(await run_db(api.remove_soldier, await request.get_json()))
+
+
+@app.route('/soldiers/<int:unit_id>', methods=['GET'])
+@conditional
+async def get_soldiers_by_unit(unit_id):
+    return respond(await run_db(api.soldiers_by_unit, unit_id))
+
+
+@app.route('/addunit', methods=['POST'])
+async def add_unit():
+    return respond(await run_db(api.add_unit, await request.get_json()))
+
+
+@app.route('/assign', methods=['POST'])
+async def assign_soldier_to_unit():
+    return respond(await run_db(api.assign_soldier_to_unit, await request.get_json()))
+
+
+@app.route('/units', methods=['GET'])
+@conditional
+async def get_all_units():
+    return respond(await run_db(api.all_units))
+
+
+@app.route('/addaward/<int:soldier_id>/<int:award_id>', methods=['GET'])
+async def add_award(soldier_id, award_id):
+    return respond(await run_db(api.add_award, soldier_id, award_id))
+
+
+@app.route('/removeaward/<int:soldier_id>/<int:award_id>', methods=['GET'])
+async def remove_award(soldier_id, award_id):
+    return respond(await run_db(api.remove_award, soldier_id, award_id))
+
+
+@app.route('/awards/grant', methods=['POST'])
+async def grant_awards():
+    return respond(await run_db(api.grant_awards, await request.get_json(silent=True), app.config))
+
+
+@app.route('/getawards/<int:soldier_id>', methods=['GET'])
+@conditional
+async def get_award_by_solider(soldier_id):
+    return respond(await run_db(api.awards_by_soldier, soldier_id))
+
+
+@app.route('/getallawards', methods=['GET'])
+@conditional
+async def get_all_awards():
+    return respond(await run_db(api.all_awards))
+
+
+@app.route('/images/<name>', methods=['GET'])
+async def get_award_image(name):
+    image = api.image_file(app.config, name, request.args.get('size'))
+    if image is None:
+        return respond(api.error('Image not found', 404))
+    name, path, mimetype = image
+    response = await send_file(path, mimetype=mimetype, cache_timeout=app.config['IMAGE_MAX_AGE'],
+                               conditional=True)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+@app.route('/adddemerit/<int:soldier_id>', methods=['POST'])
+async def add_demerit(soldier_id):
+    return respond(await run_db(api.add_demerit, soldier_id, await request.get_json(silent=True)))
+
+
+@app.route('/demerits/batch', methods=['POST'])
+async def add_demerits_batch():
+    return respond(await run_db(api.add_demerits_batch, await request.get_json(silent=True), app.config))
+
+
+@app.route('/demerits', methods=['GET'])
+@conditional
+async def get_all_demerits():
+    return respond(await run_db(api.all_demerits, route_serializer_name() == dbJson.SQLITE))
+
+
+@app.route('/demerits/<int:soldier_id>', methods=['GET'])
+@conditional
+async def get_soldier_demerits(soldier_id):
+    return respond(await run_db(api.soldier_demerits, soldier_id, route_serializer_name() == dbJson.SQLITE))
+
+
+if __name__ == '__main__':
+    app.run(debug=True, port=5001)
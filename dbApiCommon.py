@@ -0,0 +1,312 @@
+import zlib
+
+import dbJson
+from awardImages import ImageStore, IMAGE_DIR, THUMBNAIL_SIZES
+from mdbTests import ConnectionPool, SERVER_PROFILE, create_data_version
+
+# What dbApi (Flask) and dbApiAsync (Quart) share: configuration, connection
+# pools, ETags, request validation and the route logic itself. A route handler
+# takes a MilitaryDatabase first and returns (data, status), where data is
+# serialized with the route's JSON serializer, sent as is when it is RawJson,
+# or left out when it is None. The apps only add the framework glue: Flask
+# calls handlers on its request thread, Quart on its database executor.
+
+
+def configure(config):
+    config.setdefault('DATABASE', '29awards.db')
+    config.setdefault('DB_PROFILE', SERVER_PROFILE)
+    # All writes share one connection; reads are spread over read-only connections
+    config.setdefault('DB_POOL_SIZE', 1)
+    config.setdefault('DB_READ_POOL_SIZE', 8)
+    config.setdefault('DB_POOL_TIMEOUT', 10.0)
+    # 'auto' uses orjson when it is installed and the compact stdlib encoder otherwise.
+    # JSON_ROUTE_SERIALIZERS overrides it per endpoint; 'sqlite' has SQLite build the JSON
+    # text for routes that support it (the demerit lists).
+    config.setdefault('JSON_SERIALIZER', 'auto')
+    config.setdefault('JSON_ROUTE_SERIALIZERS', {
+        'get_all_demerits': dbJson.SQLITE,
+        'get_soldier_demerits': dbJson.SQLITE,
+    })
+    config.setdefault('SOLDIERS_PAGE_SIZE', 100)
+    config.setdefault('SOLDIERS_MAX_PAGE_SIZE', 1000)
+    config.setdefault('SEARCH_PAGE_SIZE', 20)
+    config.setdefault('SEARCH_MAX_PAGE_SIZE', 100)
+    # Mirrored award images are content-addressed, so a name never changes meaning
+    config.setdefault('IMAGE_DIR', IMAGE_DIR)
+    config.setdefault('IMAGE_MAX_AGE', 365 * 24 * 3600)
+    # Upper bound on listed items in one /awards/grant or /demerits/batch request
+    config.setdefault('BATCH_MAX_ITEMS', 10000)
+
+
+def open_pools(config):
+    writer = ConnectionPool(config['DATABASE'], size=config['DB_POOL_SIZE'],
+                            timeout=config['DB_POOL_TIMEOUT'], profile=config['DB_PROFILE'])
+    # Open the writer first so the file is switched to WAL, and has its data_version row,
+    # before any read-only connection opens it
+    conn = writer.acquire()
+    create_data_version(conn)
+    writer.release(conn)
+    readers = ConnectionPool(config['DATABASE'], size=config['DB_READ_POOL_SIZE'],
+                             timeout=config['DB_POOL_TIMEOUT'], profile=config['DB_PROFILE'],
+                             read_only=True)
+    return writer, readers
+
+
+def pool_metrics(pools):
+    writer, readers = pools
+    return {'writer': writer.metrics(), 'readers': readers.metrics()}
+
+
+def etag(version, full_path):
+    # Read before the view runs, so a write that lands mid-request can only
+    # make the client fetch again, never keep stale data
+    return f"{version}-{zlib.crc32(full_path.encode()):08x}"
+
+
+def serializer_name(config, endpoint):
+    return config['JSON_ROUTE_SERIALIZERS'].get(endpoint, config['JSON_SERIALIZER'])
+
+
+class RawJson(bytes):
+    # JSON text SQLite already built; sent without serializing again
+    pass
+
+
+def image_file(config, name, size=None):
+    # (name, absolute path, mimetype) of a mirrored award image, or of its
+    # thumbnail when size is a THUMBNAIL_SIZES kind; None if not stored
+    store = ImageStore(config['IMAGE_DIR'])
+    if size is not None:
+        if size not in THUMBNAIL_SIZES or not store.exists(name):
+            return None
+        name = store.thumbnail_name(name, size)
+    if not store.exists(name):
+        return None
+    return name, store.path(name), store.content_type(name)
+
+
+# Request validation
+
+GRANT_FIELDS = ['soldier_id', 'award_id']
+DEMERIT_FIELDS = ['soldier_id', 'demerit_name', 'demerit_description', 'demerit_signature']
+REQUIRED_FIELDS = {'soldier_id', 'award_id', 'demerit_name', 'demerit_signature'}
+STRING_FIELDS = {'demerit_name', 'demerit_description', 'demerit_signature'}
+# SQLite integers are signed 64-bit; anything larger cannot even be bound
+MIN_ID, MAX_ID = -2 ** 63, 2 ** 63 - 1
+
+
+def parse_batch_item(item, fields):
+    # Items are objects keyed by field or arrays in field order; raises ValueError
+    if isinstance(item, dict):
+        item = [item.get(field) for field in fields]
+    if not isinstance(item, list) or len(item) > len(fields):
+        raise ValueError(f"Expected an object or an array of {', '.join(fields)}")
+    item = item + [None] * (len(fields) - len(item))
+    for field, value in zip(fields, item):
+        if value is None:
+            if field in REQUIRED_FIELDS:
+                raise ValueError(f'{field} is required')
+        elif field.endswith('_id'):
+            check_id(field, value)
+        elif field in STRING_FIELDS and not isinstance(value, str):
+            raise ValueError(f'{field} must be a string')
+    return item
+
+
+def check_id(field, value):
+    # JSON true and false decode to bool, which is an int subclass
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise ValueError(f'{field} must be an integer')
+    if not MIN_ID <= value <= MAX_ID:
+        raise ValueError(f'{field} is out of range')
+
+
+def parse_batch(data, key, fields, max_items):
+    # A batch body lists items under key, targets a unit with unit_id and the
+    # item fields other than soldier_id, or both. Returns (items, unit_id,
+    # the unit target's fields, recursive).
+    if not isinstance(data, dict):
+        raise ValueError('Expected a JSON object')
+    items = data.get(key, [])
+    if not isinstance(items, list):
+        raise ValueError(f'{key} must be a list')
+    if len(items) > max_items:
+        raise ValueError(f"At most {max_items} {key} per request")
+    items = [parse_batch_item(item, fields) for item in items]
+    unit_id = data.get('unit_id')
+    target = None
+    if unit_id is not None:
+        check_id('unit_id', unit_id)
+        target = parse_batch_item([unit_id] + [data.get(field) for field in fields[1:]], fields)[1:]
+    elif not items:
+        raise ValueError(f'{key} or unit_id is required')
+    recursive = data.get('recursive', True)
+    if not isinstance(recursive, bool):
+        raise ValueError('recursive must be true or false')
+    return items, unit_id, target, recursive
+
+
+def error(message, status):
+    return {'error': message}, status
+
+
+# Route handlers
+
+def soldiers(db, args, config):
+    if 'limit' in args or 'cursor' in args:
+        limit = args.get('limit', config['SOLDIERS_PAGE_SIZE'], type=int)
+        limit = max(1, min(limit, config['SOLDIERS_MAX_PAGE_SIZE']))
+        cursor = args.get('cursor', 0, type=int)
+        page = db.retrieve_soldiers_page(cursor, limit)
+        next_cursor = page[-1][0] if len(page) == limit else None
+        return {'soldiers': page, 'next_cursor': next_cursor}, 200
+    return db.retrieve_all_soldiers(), 200
+
+
+def search_soldiers(db, args, config):
+    text = args.get('q', '').strip()
+    if not text:
+        return error('q is required', 400)
+    if not db.has_search_index():
+        return error('Search is not available: this database has no search index', 501)
+    limit = args.get('limit', config['SEARCH_PAGE_SIZE'], type=int)
+    limit = max(1, min(limit, config['SEARCH_MAX_PAGE_SIZE']))
+    offset = max(0, args.get('offset', 0, type=int))
+    results = db.search_soldiers(text, limit, offset)
+    next_offset = offset + limit if len(results) == limit else None
+    return {'results': results, 'next_offset': next_offset}, 200
+
+
+def units_by_parent(db, parent_unit_id):
+    return db.retrieve_units_by_parent(parent_unit_id), 200
+
+
+def unit_tree(db, unit_id, args):
+    include_soldiers = args.get('include_soldiers', 'false').lower() in ('1', 'true', 'yes')
+    tree = db.get_unit_subtree(unit_id, include_soldiers=include_soldiers)
+    if tree is None:
+        return error(f'Unit {unit_id} not found', 404)
+    return tree, 200
+
+
+def unit_ancestors(db, unit_id):
+    return db.get_unit_ancestors(unit_id), 200
+
+
+def soldiers_under_unit(db, unit_id):
+    return db.get_soldiers_under_unit(unit_id), 200
+
+
+def unit_stats(db, unit_id):
+    stats = db.get_unit_stats(unit_id)
+    if stats is None:
+        return error(f'Unit {unit_id} not found', 404)
+    return stats, 200
+
+
+def move_unit(db, unit_id, data):
+    try:
+        db.move_unit(unit_id, data.get('parent_unit_id'))
+    except ValueError as e:
+        return error(str(e), 400)
+    return None, 204
+
+
+def units_with_soldiers(db):
+    return db.retrieve_units_with_soldiers(), 200
+
+
+def add_soldier(db, data):
+    soldier_id = db.add_soldier(data['name'], data['age'], data.get('country', ''), data['address'], data['rank'],
+                                data['ait'], data['unit_id'], data.get('leadership', 0))
+    return {'id': soldier_id}, 201
+
+
+def remove_soldier(db, data):
+    db.remove_soldier(data['id'])
+    return None, 204
+
+
+def soldiers_by_unit(db, unit_id):
+    return db.get_soldiers_by_unit(unit_id), 200
+
+
+def add_unit(db, data):
+    unit_id = db.add_unit(data['name'], data['type'], data['image'], data.get('parent_unit_id'))
+    return {'id': unit_id}, 201
+
+
+def assign_soldier_to_unit(db, data):
+    db.assign_soldier_to_unit(data['soldier_id'], data['unit_id'])
+    return None, 204
+
+
+def all_units(db):
+    return db.retrieve_all_units(), 200
+
+
+def add_award(db, soldier_id, award_id):
+    db.add_award_to_soldier(soldier_id, award_id)
+    return None, 204
+
+
+def remove_award(db, soldier_id, award_id):
+    db.remove_award_from_soldier(soldier_id, award_id)
+    return None, 204
+
+
+def grant_awards(db, data, config):
+    try:
+        grants, unit_id, target, recursive = parse_batch(data, 'grants', GRANT_FIELDS, config['BATCH_MAX_ITEMS'])
+    except ValueError as e:
+        return error(str(e), 400)
+    results = db.grant_awards(grants, unit_id=unit_id, award_id=target and target[0], recursive=recursive)
+    granted = sum(1 for result in results if result['status'] == 'granted')
+    return {'results': results, 'granted': granted}, 200
+
+
+def awards_by_soldier(db, soldier_id):
+    return db.get_awards_by_soldier(soldier_id), 200
+
+
+def all_awards(db):
+    return db.get_all_awards(), 200
+
+
+def add_demerit(db, soldier_id, data):
+    try:
+        if not isinstance(data, dict):
+            raise ValueError('Expected a JSON object')
+        demerit = parse_batch_item([soldier_id] + [data.get(field) for field in DEMERIT_FIELDS[1:]], DEMERIT_FIELDS)
+    except ValueError as e:
+        return error(str(e), 400)
+    try:
+        db.add_demerit_to_soldier(*demerit)
+    except LookupError as e:
+        return error(str(e), 404)
+    return None, 204
+
+
+def add_demerits_batch(db, data, config):
+    try:
+        demerits, unit_id, target, recursive = parse_batch(data, 'demerits', DEMERIT_FIELDS,
+                                                           config['BATCH_MAX_ITEMS'])
+    except ValueError as e:
+        return error(str(e), 400)
+    results = db.add_demerits_bulk(demerits, unit_id=unit_id, demerit=target, recursive=recursive)
+    added = sum(1 for result in results if result['status'] == 'added')
+    return {'results': results, 'added': added}, 200
+
+
+# Rows come back already shaped by the query's column aliases; with raw_json
+# SQLite builds the whole JSON text
+def all_demerits(db, raw_json):
+    if raw_json:
+        return RawJson(db.get_all_soldier_demerits(shape='json')), 200
+    return db.get_all_soldier_demerits(shape='dicts'), 200
+
+
+def soldier_demerits(db, soldier_id, raw_json):
+    if raw_json:
+        return RawJson(db.get_demerits_for_soldier(soldier_id, shape='json')), 200
+    return db.get_demerits_for_soldier(soldier_id, shape='dicts'), 200
@@ -0,0 +1,297 @@
+import argparse
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# Benchmarks for the database layer and the two API servers.
+#     python dbBench.py api --concurrency 64 --requests 2000
+#     python dbBench.py json --rows 100000
+#     python dbBench.py records --rows 100000
+#     python dbBench.py profiles --sizes 1000,10000,100000,1000000
+#     python dbBench.py scrape --html saved_awards.html
+
+
+def timed(fn, repeat=5):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def build_bench_db(rows):
+    from mdbTests import MilitaryDatabase
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    db = MilitaryDatabase(path)
+    db.create_tables()
+    unit_ids = db.add_units_bulk([(f"Squad {i}", "Squad", "https://placehold.co/600x400") for i in range(100)])
+    soldier_ids = db.add_soldiers_bulk(
+        (f"Soldier {i}", random.randint(20, 40), "US", "123 Elm St", "Private", "Rifle", random.choice(unit_ids),
+         i % 10 == 0)
+        for i in range(rows))
+    db.add_demerits_bulk((i, f"Demerit {i}", "Late to drill", "Sgt. Smith") for i in soldier_ids)
+    return db, path
+
+
+def wait_for_server(url, timeout=20.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server at {url} did not come up")
+
+
+def start_flask(port):
+    code = f"from dbApi import app; app.run(port={port}, threaded=True)"
+    return subprocess.Popen([sys.executable, "-c", code], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def start_asgi(port):
+    return subprocess.Popen([sys.executable, "-m", "hypercorn", "dbApiAsync:app", "--bind", f"127.0.0.1:{port}"],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def load_test(base_url, paths, concurrency, total):
+    local = threading.local()
+
+    def one(i):
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        started = time.perf_counter()
+        response = session.get(base_url + paths[i % len(paths)])
+        response.raise_for_status()
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = sorted(pool.map(one, range(total)))
+    elapsed = time.perf_counter() - started
+    return {
+        "req/s": total / elapsed,
+        "p50 ms": statistics.median(latencies) * 1000,
+        "p99 ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+
+def bench_api(args):
+    paths = args.paths.split(",")
+    servers = [("flask", start_flask, args.flask_port), ("asgi", start_asgi, args.asgi_port)]
+    for name, start, port in servers:
+        process = start(port)
+        try:
+            base_url = f"http://127.0.0.1:{port}"
+            wait_for_server(base_url + "/poolstats")
+            load_test(base_url, paths, args.concurrency, min(args.requests, 200))  # warm up
+            result = load_test(base_url, paths, args.concurrency, args.requests)
+            print(f"{name:6} " + "  ".join(f"{key} {value:9.1f}" for key, value in result.items()))
+        finally:
+            process.terminate()
+            process.wait()
+
+
+def bench_json(args):
+    import dbJson
+    from dbApi import app
+    from flask import jsonify
+
+    db, path = build_bench_db(args.rows)
+    try:
+        def legacy():
+            # What /demerits did before: tuples, a dict per row built in Python, then jsonify
+            with app.app_context():
+                response = []
+                for row in db.get_all_soldier_demerits():
+                    response.append({
+                        'soldier_id': row[0],
+                        'soldier_name': row[1],
+                        'demerit_id': row[2],
+                        'demerit_name': row[3],
+                        'demerit_description': row[4],
+                        'demerit_signature': row[5]
+                    })
+                return jsonify(response).get_data()
+
+        cases = [("jsonify + dict loop", legacy)]
+        for name in dbJson.SERIALIZERS:
+            dumps = dbJson.get_serializer(name)
+            cases.append((f"dicts + {name}", lambda dumps=dumps: dumps(db.get_all_soldier_demerits(shape="dicts"))))
+            cases.append((f"tuples + {name}", lambda dumps=dumps: dumps(db.get_all_soldier_demerits())))
+        cases.append(("sqlite json_group_array", lambda: db.get_all_soldier_demerits(shape="json")))
+
+        print(f"/demerits payload, {args.rows} rows")
+        baseline = None
+        for name, fn in cases:
+            seconds = timed(fn)
+            baseline = baseline or seconds
+            print(f"  {name:24} {seconds * 1000:8.1f} ms  {baseline / seconds:5.2f}x")
+    finally:
+        db.close()
+        os.remove(path)
+
+
+class SlotsSoldier:
+    __slots__ = ("id", "name", "age", "country", "address", "rank", "ait", "unit_id", "leadership", "date")
+
+    def __init__(self, *row):
+        (self.id, self.name, self.age, self.country, self.address, self.rank, self.ait, self.unit_id,
+         self.leadership, self.date) = row
+
+
+def bench_records(args):
+    from mdbTests import fetch_records
+
+    db, path = build_bench_db(args.rows)
+    try:
+        def select():
+            cur = db.read_conn.cursor()
+            cur.execute("SELECT * FROM soldiers")
+            return cur
+
+        def as_dicts():
+            cur = select()
+            columns = [column[0] for column in cur.description]
+            return [dict(zip(columns, row)) for row in cur]
+
+        cases = [
+            ("tuples (fetchall)", lambda: select().fetchall()),
+            ("dicts", as_dicts),
+            ("records (namedtuple)", lambda: fetch_records(select(), "Soldier")),
+            ("__slots__ objects", lambda: [SlotsSoldier(*row) for row in select()]),
+        ]
+        print(f"soldiers table, {args.rows} rows")
+        for name, fn in cases:
+            seconds = timed(fn, repeat=3)
+            tracemalloc.start()
+            rows = fn()
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del rows
+            print(f"  {name:22} {seconds * 1000:8.1f} ms  {size / 2 ** 20:7.1f} MiB  {size / args.rows:6.0f} B/row")
+    finally:
+        db.close()
+        os.remove(path)
+
+
+def bench_profiles(args):
+    from mdbTests import Profile, ProfileManager
+
+    db, path = build_bench_db(0)
+    ranks = ["Private", "Corporal", "Sergeant", "Lieutenant", "Captain"]
+    aits = ["Rifle", "CE", "Medic", "GL", "AR"]
+    squads = [f"Squad {i}" for i in range(256)]
+    print(f"{'profiles':>9} {'bulk load':>10} {'lookup':>9} {'by rank':>9} {'update':>9} {'delete':>9} {'list scan':>10}")
+    try:
+        for size in map(int, args.sizes.split(",")):
+            profiles = [Profile(name=f"Soldier {i}", age=20 + i % 20, address="123 Elm St", rank=ranks[i % len(ranks)],
+                                ait=aits[i % len(aits)], squad=squads[i % len(squads)]) for i in range(size)]
+            manager = ProfileManager(db)
+            started = time.perf_counter()
+            manager.add_profiles(profiles)
+            load = time.perf_counter() - started
+
+            sample = random.sample(profiles, min(args.ops, size))
+            per_op = lambda fn: timed(lambda: [fn(p) for p in sample], repeat=3) / len(sample) * 1e6
+            lookup = per_op(lambda p: manager.find_profile(p.name, p.age))
+            by_rank = per_op(lambda p: manager.by_rank[p.rank])
+            update = per_op(lambda p: manager.set_rank(p, ranks[(ranks.index(p.rank) + 1) % len(ranks)]))
+            # What search_profile cost before the indexes, on a handful of lookups
+            scan_sample = sample[:20]
+            scan = timed(lambda: [next(q for q in profiles if q.name == p.name and q.age == p.age)
+                                  for p in scan_sample], repeat=1) / len(scan_sample) * 1e6
+            started = time.perf_counter()
+            for p in sample:
+                manager.remove_profile(p.id)
+            delete = (time.perf_counter() - started) / len(sample) * 1e6
+            print(f"{size:>9} {load * 1000:8.1f}ms {lookup:7.2f}us {by_rank:7.2f}us {update:7.2f}us {delete:7.2f}us "
+                  f"{scan:8.1f}us")
+    finally:
+        db.close()
+        os.remove(path)
+
+
+def sample_awards_page():
+    # Stand-in for a saved copy of /about/awards built from the seed catalog
+    from mdbTests import awards
+    blocks = []
+    for name, description, image_bg, image_sm in awards:
+        images = "".join(f'<img class="img-fluid" src="{src}" alt="">' for src in (image_bg, image_sm) if src)
+        blocks.append(f'<div class="media mb-4"><div class="award-images mr-3">{images}</div>'
+                      f'<div class="media-body"><h5 class="mt-0">{name}</h5><p>{description}</p></div></div>')
+    chrome = '<nav class="navbar"><ul>' + '<li><a href="/x">Link</a></li>' * 50 + '</ul></nav>'
+    return (f'<!DOCTYPE html><html><head><title>Awards</title></head><body>{chrome}'
+            f'<div class="container"><h1>Awards</h1>{"".join(blocks)}</div>{chrome}</body></html>')
+
+
+def bench_scrape(args):
+    import awardScraper
+    from bs4 import FeatureNotFound
+
+    if args.html:
+        with open(args.html, encoding="utf-8") as f:
+            page = f.read()
+    else:
+        page = sample_awards_page()
+    reference = None
+    print(f"award page, {len(page) / 1024:.0f} KiB")
+    for name in awardScraper.AWARD_PARSERS:
+        try:
+            awards = awardScraper.award_info(page, name)
+        except FeatureNotFound:  # lxml is optional
+            print(f"  {name:14} unavailable, lxml is not installed")
+            continue
+        reference = reference or awards
+        seconds = timed(lambda: awardScraper.award_info(page, name))
+        same = "same" if awards == reference else "DIFFERENT"
+        print(f"  {name:14} {seconds * 1000:8.2f} ms  {len(awards)} awards  {same}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="29th database benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    api = commands.add_parser("api", help="Flask (threaded WSGI) vs Quart (ASGI) under concurrent load")
+    api.add_argument("--paths", default="/units,/getallawards,/soldiers/5,/allunitsandsoldiers")
+    api.add_argument("--concurrency", type=int, default=64)
+    api.add_argument("--requests", type=int, default=2000)
+    api.add_argument("--flask-port", type=int, default=5100)
+    api.add_argument("--asgi-port", type=int, default=5101)
+    api.set_defaults(func=bench_api)
+
+    json_bench = commands.add_parser("json", help="Response serialization paths for large list routes")
+    json_bench.add_argument("--rows", type=int, default=100000)
+    json_bench.set_defaults(func=bench_json)
+
+    records = commands.add_parser("records", help="Per-row time and memory of tuples, dicts and typed records")
+    records.add_argument("--rows", type=int, default=100000)
+    records.set_defaults(func=bench_records)
+
+    profiles = commands.add_parser("profiles", help="ProfileManager index scaling")
+    profiles.add_argument("--sizes", default="1000,10000,100000,1000000")
+    profiles.add_argument("--ops", type=int, default=10000)
+    profiles.set_defaults(func=bench_profiles)
+
+    scrape = commands.add_parser("scrape", help="award_info parser backends on a saved awards page")
+    scrape.add_argument("--html", help="saved copy of /about/awards; a page built from the seed catalog otherwise")
+    scrape.set_defaults(func=bench_scrape)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
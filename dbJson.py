@@ -0,0 +1,53 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Response body serializers. Each one turns the rows/dicts returned by
+# MilitaryDatabase into JSON bytes in one call, without Flask's jsonify
+# wrapping (which sorts keys and builds an intermediate str).
+
+_compact_encoder = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False, check_circular=False)
+
+
+def dumps_stdlib(data):
+    return _compact_encoder.encode(data).encode("utf-8")
+
+
+def _orjson_default(obj):
+    # orjson only knows exact tuples; MilitaryDatabase records are namedtuples
+    if isinstance(obj, tuple):
+        return list(obj)
+    raise TypeError
+
+
+def dumps_orjson(data):
+    # orjson writes tuples, lists and dicts straight to bytes; used when installed
+    return orjson.dumps(data, default=_orjson_default)
+
+
+SERIALIZERS = {
+    "stdlib": dumps_stdlib,
+}
+if orjson is not None:
+    SERIALIZERS["orjson"] = dumps_orjson
+
+
+# Routes whose rows can be turned into JSON by SQLite itself (json_group_array)
+# accept this name and skip Python objects entirely; anywhere else it means "auto".
+SQLITE = "sqlite"
+
+
+def get_serializer(name="auto"):
+    if name in ("auto", SQLITE):
+        return SERIALIZERS.get("orjson", dumps_stdlib)
+    try:
+        return SERIALIZERS[name]
+    except KeyError:
+        raise ValueError(f"Unknown JSON serializer {name!r}, expected one of {sorted(SERIALIZERS)} or 'auto'/'sqlite'")
+
+
+def dumps(data, name="auto"):
+    return get_serializer(name)(data)
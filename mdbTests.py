@@ -1,11 +1,658 @@
+import hashlib
+import json
+import os
+import queue
 import random
 import sqlite3
+import threading
+import time
+from collections import OrderedDict, namedtuple
 from datetime import datetime
 import names
 
+# Connection settings for the API server: WAL lets readers run alongside the
+# single writer, NORMAL sync is durable across crashes of the process in WAL
+# mode, and busy_timeout makes writers queue instead of failing with "locked".
+SERVER_PROFILE = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -64000,  # KiB, i.e. 64 MB per connection
+    "mmap_size": 268435456,
+    "busy_timeout": 5000,
+    "temp_store": "MEMORY",
+}
+
+
+def apply_profile(conn, profile, read_only=False):
+    if not profile:
+        return
+    for pragma, value in profile.items():
+        # journal_mode is stored in the database file and can only be set by a writer
+        if read_only and pragma == "journal_mode":
+            continue
+        conn.execute(f"PRAGMA {pragma} = {value}")
+
+
+def connect(db_name, profile=None, read_only=False, check_same_thread=True):
+    if read_only:
+        conn = sqlite3.connect(f"file:{db_name}?mode=ro", uri=True, check_same_thread=check_same_thread)
+    else:
+        conn = sqlite3.connect(db_name, check_same_thread=check_same_thread)
+    apply_profile(conn, profile, read_only)
+    return conn
+
+
+# Typed rows. Each record type is a namedtuple (so __slots__ = (), no per-row
+# dict) built from the columns the query actually returned, which keeps named
+# access working across the older 29th.db / 29test.db schemas. Records still
+# serialize as JSON arrays, the same as the plain tuples they replace.
+record_types = {}
+
+
+def record_type(name, columns):
+    key = (name, columns)
+    cls = record_types.get(key)
+    if cls is None:
+        cls = namedtuple(name, columns, rename=True)
+        record_types[key] = cls
+    return cls
+
+
+def fetch_records(cur, name):
+    cls = record_type(name, tuple(column[0] for column in cur.description))
+    return list(map(cls._make, cur))
+
+
+def fetch_shaped(cur, query, params=(), shape="rows", name="Record"):
+    # shape "rows" returns records, "dicts" returns {column alias: value} per row and
+    # "json" has SQLite build the whole JSON array itself and returns it as bytes
+    if shape == "json":
+        cur.execute(f"SELECT * FROM ({query}) LIMIT 0", params)
+        fields = ", ".join(f"'{column[0]}', \"{column[0]}\"" for column in cur.description)
+        cur.execute(f"SELECT json_group_array(json_object({fields})) FROM ({query})", params)
+        return cur.fetchone()[0].encode("utf-8")
+
+    cur.execute(query, params)
+    if shape == "dicts":
+        columns = [column[0] for column in cur.description]
+        return [dict(zip(columns, row)) for row in cur]
+    return fetch_records(cur, name)
+
+
+class ConnectionPool:
+    def __init__(self, db_name, size=5, timeout=10.0, profile=None, read_only=False):
+        self.db_name = db_name
+        self.size = size
+        self.timeout = timeout
+        self.profile = profile
+        self.read_only = read_only
+        self._idle = queue.LifoQueue(maxsize=size)
+        self._lock = threading.Lock()
+        self._created = 0
+        self._closed = False
+        self.stats = {"created": 0, "acquired": 0, "released": 0, "discarded": 0, "waits": 0, "in_use": 0}
+
+    def _connect(self):
+        return connect(self.db_name, self.profile, self.read_only, check_same_thread=False)
+
+    def _is_healthy(self, conn):
+        try:
+            conn.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            self._created -= 1
+            self.stats["discarded"] += 1
+
+    def acquire(self):
+        if self._closed:
+            raise RuntimeError("Connection pool is closed")
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = None
+                with self._lock:
+                    if self._created < self.size:
+                        self._created += 1
+                        self.stats["created"] += 1
+                        create = True
+                    else:
+                        create = False
+                if create:
+                    try:
+                        conn = self._connect()
+                    except sqlite3.Error:
+                        with self._lock:
+                            self._created -= 1
+                        raise
+                else:
+                    with self._lock:
+                        self.stats["waits"] += 1
+                    try:
+                        conn = self._idle.get(timeout=self.timeout)
+                    except queue.Empty:
+                        raise TimeoutError(f"No database connection available after {self.timeout}s")
+
+            # Drop connections that went bad while idle and try again
+            if not self._is_healthy(conn):
+                self._discard(conn)
+                continue
+
+            with self._lock:
+                self.stats["acquired"] += 1
+                self.stats["in_use"] += 1
+            return conn
+
+    def release(self, conn):
+        with self._lock:
+            self.stats["released"] += 1
+            self.stats["in_use"] -= 1
+
+        # Never hand a connection with an open transaction to the next request
+        if self._closed or not self._is_healthy(conn):
+            self._discard(conn)
+            return
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put_nowait(conn)
+
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self.stats)
+            metrics["size"] = self.size
+            metrics["open"] = self._created
+        metrics["idle"] = self._idle.qsize()
+        return metrics
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(conn)
+
+
+class QueryCache:
+    # Read-through cache for near-static catalog reads (award list, unit list).
+    # Entries expire after ttl seconds and the least recently used one is
+    # evicted once maxsize is reached. Writers call invalidate() with the keys
+    # they touched, and sync() drops everything once the database's data
+    # version shows a write from another process. Cached values are shared,
+    # so callers must not mutate them.
+    def __init__(self, maxsize=128, ttl=300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._version = None
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def get_or_load(self, key, loader):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[1]
+            self.stats["misses"] += 1
+            generation = self._generation
+
+        value = loader()
+        with self._lock:
+            # A write landed while we were loading, so this value may already be stale
+            if generation != self._generation:
+                return value
+            self._entries[key] = (now + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+        return value
+
+    def invalidate(self, *keys):
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    self.stats["invalidations"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self.stats["invalidations"] += len(self._entries)
+            self._entries.clear()
+
+    def sync(self, version):
+        with self._lock:
+            if version == self._version:
+                return
+            self._version = version
+        self.clear()
+
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self.stats)
+            metrics["size"] = len(self._entries)
+            metrics["maxsize"] = self.maxsize
+            metrics["ttl"] = self.ttl
+        return metrics
+
+
+# Version of the data in a database file, shared by every process that opens
+# it: MilitaryDatabase bumps the row after each committed write, so writes from
+# other API workers, the seeding script or the scraper sync move it too. The
+# token is random per database file, so a recreated file never repeats an old
+# version.
+DATA_VERSION_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS data_version (
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        token TEXT NOT NULL,
+        version INTEGER NOT NULL
+    )
+    """,
+    "INSERT OR IGNORE INTO data_version (id, token, version) VALUES (0, lower(hex(randomblob(4))), 0)",
+]
+
+
+def create_data_version(conn):
+    with conn:
+        for statement in DATA_VERSION_SCHEMA:
+            conn.execute(statement)
+
+
+def read_data_version(conn):
+    # "token-version", or None for a database without the data_version table
+    try:
+        row = conn.execute("SELECT token || '-' || version FROM data_version").fetchone()
+    except sqlite3.OperationalError as e:
+        if "no such table" not in str(e):
+            raise
+        return None
+    return row[0] if row else None
+
+
+# One cache per database file, shared by every MilitaryDatabase opened on it
+query_caches = {}
+registry_lock = threading.Lock()
+
+
+def get_query_cache(db_name):
+    with registry_lock:
+        cache = query_caches.get(db_name)
+        if cache is None:
+            cache = QueryCache()
+            query_caches[db_name] = cache
+        return cache
+
+
+# Each entry is one schema version (indexes, columns, data fixes), tracked with
+# PRAGMA user_version. Append new versions instead of editing old ones so
+# existing databases (29th.db, 29awards.db, ...) can be brought up to date
+# with migrate_schema().
+SCHEMA_MIGRATIONS = [
+    [
+        "CREATE INDEX IF NOT EXISTS idx_soldiers_unit_id ON soldiers (unit_id)",
+        "CREATE INDEX IF NOT EXISTS idx_units_parent_unit_id ON units (parent_unit_id)",
+        "CREATE INDEX IF NOT EXISTS idx_soldiers_leaders ON soldiers (id) WHERE leadership = 1",
+        "CREATE INDEX IF NOT EXISTS idx_soldier_awards_award_id ON soldier_awards (award_id)",
+        "CREATE INDEX IF NOT EXISTS idx_soldier_demerits_demerit_id ON soldier_demerits (demerit_id)",
+    ],
+    [
+        "CREATE INDEX IF NOT EXISTS idx_unit_closure_descendant ON unit_closure (descendant_id, depth)",
+    ],
+    # Award catalog sync (see sync_awards): fold duplicate award names into the
+    # oldest row, keeping soldiers' awards, then make award_name unique. Only
+    # rows pointing at a duplicate are touched; a soldier_awards row whose
+    # award no longer exists is left as it is.
+    [
+        "ALTER TABLE awards ADD COLUMN content_hash TEXT",
+        """
+        UPDATE OR IGNORE soldier_awards SET award_id = (
+            SELECT MIN(keep.id) FROM awards keep JOIN awards dup ON dup.award_name = keep.award_name
+            WHERE dup.id = soldier_awards.award_id
+        )
+        WHERE award_id IN (SELECT id FROM awards WHERE id NOT IN (SELECT MIN(id) FROM awards GROUP BY award_name))
+        """,
+        # What is left on a duplicate was already held through the kept row
+        """
+        DELETE FROM soldier_awards
+        WHERE award_id IN (SELECT id FROM awards WHERE id NOT IN (SELECT MIN(id) FROM awards GROUP BY award_name))
+        """,
+        "DELETE FROM awards WHERE id NOT IN (SELECT MIN(id) FROM awards GROUP BY award_name)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_awards_award_name ON awards (award_name)",
+    ],
+    # Demerit type catalog (see add_demerits_bulk): identical demerits share
+    # one demerits row, so soldier_demerits is rebuilt without its
+    # (soldier_id, demerit_id) key to let a soldier get the same demerit twice
+    [
+        """
+        CREATE TABLE soldier_demerits_v4 (
+            soldier_id INTEGER NOT NULL,
+            demerit_id INTEGER NOT NULL,
+            demerit_date DATE,
+            FOREIGN KEY (soldier_id) REFERENCES soldiers (id),
+            FOREIGN KEY (demerit_id) REFERENCES demerits (id)
+        )
+        """,
+        """
+        INSERT INTO soldier_demerits_v4 (soldier_id, demerit_id, demerit_date)
+        SELECT soldier_id, COALESCE((
+            SELECT MIN(keep.id) FROM demerits keep JOIN demerits dup
+              ON dup.demerit_name = keep.demerit_name
+             AND COALESCE(dup.demerit_description, '') = COALESCE(keep.demerit_description, '')
+             AND dup.demerit_signature = keep.demerit_signature
+            WHERE dup.id = soldier_demerits.demerit_id
+        ), demerit_id), demerit_date
+        FROM soldier_demerits ORDER BY rowid
+        """,
+        "DROP TABLE soldier_demerits",
+        "ALTER TABLE soldier_demerits_v4 RENAME TO soldier_demerits",
+        """
+        DELETE FROM demerits WHERE id NOT IN (
+            SELECT MIN(id) FROM demerits
+            GROUP BY demerit_name, COALESCE(demerit_description, ''), demerit_signature
+        )
+        """,
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_demerits_type
+        ON demerits (demerit_name, COALESCE(demerit_description, ''), demerit_signature)
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_soldier_demerits_soldier_id ON soldier_demerits (soldier_id)",
+        "CREATE INDEX IF NOT EXISTS idx_soldier_demerits_demerit_id ON soldier_demerits (demerit_id)",
+    ],
+]
+
+AWARD_COLUMNS = ["award_name", "award_description", "award_image_bg", "award_image_sm"]
+
+# Updates only rows whose hash differs, so rerunning a sync writes nothing
+AWARD_UPSERT = """
+    INSERT INTO awards (id, award_name, award_description, award_image_bg, award_image_sm, content_hash)
+    SELECT value ->> 0, value ->> 1, value ->> 2, value ->> 3, value ->> 4, value ->> 5 FROM json_each(?) WHERE true
+    ON CONFLICT (award_name) DO UPDATE SET
+        award_description = excluded.award_description,
+        award_image_bg = excluded.award_image_bg,
+        award_image_sm = excluded.award_image_sm,
+        content_hash = excluded.content_hash
+    WHERE awards.content_hash IS NOT excluded.content_hash
+"""
+
+
+# Award images mirrored by the scraper are served by the API under this path;
+# award reads return the local URL instead of the remote one once mirrored
+LOCAL_IMAGE_PREFIX = "/images/"
+AWARD_SELECT = f"""
+    SELECT a.id, a.award_name, a.award_description,
+           COALESCE('{LOCAL_IMAGE_PREFIX}' || bg.name, a.award_image_bg) AS award_image_bg,
+           COALESCE('{LOCAL_IMAGE_PREFIX}' || sm.name, a.award_image_sm) AS award_image_sm
+    FROM awards a
+    LEFT JOIN award_images bg ON bg.url = a.award_image_bg
+    LEFT JOIN award_images sm ON sm.url = a.award_image_sm
+"""
+
+
+SOLDIER_AWARDS_SELECT = f"""
+    SELECT award_name, award_description, award_image_bg, award_image_sm
+    FROM ({AWARD_SELECT}) a
+    JOIN soldier_awards sa ON sa.award_id = a.id
+    WHERE sa.soldier_id = ?
+"""
+
+
+def award_content_hash(award):
+    return hashlib.sha256(json.dumps(list(award[:4])).encode()).hexdigest()
+
+# Grants award ?2 to every soldier under unit ?1 (only its own soldiers unless
+# ?4) in one statement. Soldiers who already hold it are skipped, and RETURNING
+# yields exactly the soldiers who were granted it.
+UNIT_AWARD_GRANT = """
+    INSERT OR IGNORE INTO soldier_awards (soldier_id, award_id, award_date)
+    SELECT s.id, ?2, ?3
+    FROM unit_closure c
+    JOIN soldiers s ON s.unit_id = c.descendant_id
+    WHERE c.ancestor_id = ?1 AND (?4 OR c.depth = 0)
+    RETURNING soldier_id
+"""
+
+# Demerit types matching a JSON list of [name, description, signature]. A
+# missing description matches NULL or '', the same as idx_demerits_type.
+DEMERIT_TYPE_SELECT = """
+    SELECT d.id, d.demerit_name, d.demerit_description, d.demerit_signature
+    FROM json_each(?) t
+    JOIN demerits d ON d.demerit_name = t.value ->> 0
+     AND COALESCE(d.demerit_description, '') = COALESCE(t.value ->> 1, '')
+     AND d.demerit_signature = t.value ->> 2
+"""
+
+
+def demerit_type_key(name, description, signature):
+    return name, description or "", signature
+
+CLOSURE_INSERT = """
+    INSERT INTO unit_closure (ancestor_id, descendant_id, depth)
+    SELECT ?1, ?1, 0
+    UNION ALL
+    SELECT ancestor_id, ?1, depth + 1 FROM unit_closure WHERE descendant_id = ?2
+"""
+
+# Full-text index over soldiers. It is an external-content FTS5 table, so it
+# stores only the index and reads column values back through the view; the
+# triggers keep it in step with every insert, delete and searched-column update.
+# "rank" is reserved inside FTS5, hence soldier_rank. prefix='2 3' indexes
+# short prefixes so "jo*" does not scan the term list.
+SOLDIER_SEARCH_SCHEMA = [
+    """
+    CREATE VIEW IF NOT EXISTS soldiers_search_content AS
+    SELECT id, name, address, country, rank AS soldier_rank, ait FROM soldiers
+    """,
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS soldiers_fts USING fts5(
+        name, address, country, soldier_rank, ait,
+        content='soldiers_search_content', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS soldiers_fts_insert AFTER INSERT ON soldiers BEGIN
+        INSERT INTO soldiers_fts (rowid, name, address, country, soldier_rank, ait)
+        VALUES (new.id, new.name, new.address, new.country, new.rank, new.ait);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS soldiers_fts_delete AFTER DELETE ON soldiers BEGIN
+        INSERT INTO soldiers_fts (soldiers_fts, rowid, name, address, country, soldier_rank, ait)
+        VALUES ('delete', old.id, old.name, old.address, old.country, old.rank, old.ait);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS soldiers_fts_update AFTER UPDATE OF id, name, address, country, rank, ait
+    ON soldiers BEGIN
+        INSERT INTO soldiers_fts (soldiers_fts, rowid, name, address, country, soldier_rank, ait)
+        VALUES ('delete', old.id, old.name, old.address, old.country, old.rank, old.ait);
+        INSERT INTO soldiers_fts (rowid, name, address, country, soldier_rank, ait)
+        VALUES (new.id, new.name, new.address, new.country, new.rank, new.ait);
+    END
+    """,
+]
+
+
+# Tables with per-row triggers into FTS5. FTS5 flushes its pending terms at the
+# end of every statement, so executemany into these tables costs several times
+# more than one INSERT ... SELECT over the whole batch passed as JSON.
+TRIGGER_INDEXED_TABLES = {"soldiers"}
+
+
+def insert_rows(cur, table, columns, rows):
+    if table in TRIGGER_INDEXED_TABLES:
+        values = ", ".join(f"value ->> {i}" for i in range(len(columns)))
+        cur.execute(f"INSERT INTO {table} ({', '.join(columns)}) SELECT {values} FROM json_each(?)",
+                    (json.dumps(rows),))
+    else:
+        placeholders = ", ".join("?" * len(columns))
+        cur.executemany(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})", rows)
+
+
+def search_match_expression(text):
+    # Turns free text into an FTS5 query: every word must match, the last one
+    # as a prefix so results show up while the user is still typing. Words are
+    # quoted so FTS5 operators and punctuation in the input are taken literally.
+    words = [word.replace('"', '""') for word in text.split()]
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words[:-1]] + [f'"{words[-1]}"*']
+    return " ".join(terms)
+
+
+# unit_stats holds one row per unit with totals over every soldier in the
+# unit's subtree. Writes keep it current with UNIT_STATS_ADJUST deltas applied
+# to the unit and all its ancestors; UNIT_STATS_REFRESH recomputes it from the
+# base tables for the units in the JSON array ?1, or for all units when ?1 is NULL.
+UNIT_STATS_ADJUST = """
+    UPDATE unit_stats SET
+        headcount = headcount + :soldiers,
+        leaders = leaders + :leaders,
+        awards = awards + :awards,
+        demerits = demerits + :demerits,
+        ranks = CASE
+            WHEN :rank IS NULL THEN ranks
+            WHEN COALESCE(ranks ->> ('$.' || json_quote(:rank)), 0) + :soldiers > 0
+                THEN json_set(ranks, '$.' || json_quote(:rank), COALESCE(ranks ->> ('$.' || json_quote(:rank)), 0) + :soldiers)
+            ELSE json_remove(ranks, '$.' || json_quote(:rank))
+        END,
+        aits = CASE
+            WHEN :ait IS NULL THEN aits
+            WHEN COALESCE(aits ->> ('$.' || json_quote(:ait)), 0) + :soldiers > 0
+                THEN json_set(aits, '$.' || json_quote(:ait), COALESCE(aits ->> ('$.' || json_quote(:ait)), 0) + :soldiers)
+            ELSE json_remove(aits, '$.' || json_quote(:ait))
+        END
+    WHERE unit_id IN (SELECT ancestor_id FROM unit_closure WHERE descendant_id = :unit_id)
+"""
+
+UNIT_STATS_REFRESH = """
+    INSERT OR REPLACE INTO unit_stats (unit_id, headcount, leaders, awards, demerits, ranks, aits)
+    WITH targets AS (
+        SELECT id FROM units WHERE ?1 IS NULL OR id IN (SELECT value FROM json_each(?1))
+    ),
+    members AS MATERIALIZED (
+        SELECT c.ancestor_id AS unit_id, s.id AS soldier_id, s.rank, s.ait, s.leadership
+        FROM targets t
+        JOIN unit_closure c ON c.ancestor_id = t.id
+        JOIN soldiers s ON s.unit_id = c.descendant_id
+    ),
+    heads AS (
+        SELECT unit_id, COUNT(*) AS headcount, SUM(leadership != 0) AS leaders FROM members GROUP BY unit_id
+    ),
+    ranks AS (
+        SELECT unit_id, json_group_object(rank, n) AS ranks
+        FROM (SELECT unit_id, rank, COUNT(*) AS n FROM members GROUP BY unit_id, rank)
+        GROUP BY unit_id
+    ),
+    aits AS (
+        SELECT unit_id, json_group_object(ait, n) AS aits
+        FROM (SELECT unit_id, ait, COUNT(*) AS n FROM members GROUP BY unit_id, ait)
+        GROUP BY unit_id
+    ),
+    awards AS (
+        SELECT m.unit_id, COUNT(*) AS awards
+        FROM members m JOIN soldier_awards sa ON sa.soldier_id = m.soldier_id
+        GROUP BY m.unit_id
+    ),
+    demerits AS (
+        SELECT m.unit_id, COUNT(*) AS demerits
+        FROM members m JOIN soldier_demerits sd ON sd.soldier_id = m.soldier_id
+        GROUP BY m.unit_id
+    )
+    SELECT t.id, COALESCE(h.headcount, 0), COALESCE(h.leaders, 0), COALESCE(a.awards, 0),
+           COALESCE(d.demerits, 0), COALESCE(r.ranks, '{}'), COALESCE(i.aits, '{}')
+    FROM targets t
+    LEFT JOIN heads h ON h.unit_id = t.id
+    LEFT JOIN ranks r ON r.unit_id = t.id
+    LEFT JOIN aits i ON i.unit_id = t.id
+    LEFT JOIN awards a ON a.unit_id = t.id
+    LEFT JOIN demerits d ON d.unit_id = t.id
+"""
+
+
+def unit_stats_delta(unit_id, soldiers=0, leaders=0, awards=0, demerits=0, rank=None, ait=None):
+    return {"unit_id": unit_id, "soldiers": soldiers, "leaders": leaders, "awards": awards,
+            "demerits": demerits, "rank": rank, "ait": ait}
+
+
+def soldier_stats_deltas(soldiers, sign=1):
+    # soldiers are (unit_id, rank, ait, leadership); one delta per distinct
+    # (unit, rank, ait) so a bulk insert costs a few UPDATEs, not one per row
+    groups = {}
+    for unit_id, rank, ait, leadership in soldiers:
+        if unit_id is None:
+            continue
+        counts = groups.setdefault((unit_id, rank, ait), [0, 0])
+        counts[0] += 1
+        counts[1] += 1 if leadership else 0
+    return [unit_stats_delta(unit_id, soldiers=sign * count, leaders=sign * leaders, rank=rank, ait=ait)
+            for (unit_id, rank, ait), (count, leaders) in groups.items()]
+
+
+# Queries that must never fall back to a full table scan
+HOT_QUERIES = {
+    "get_soldiers_by_unit": ("SELECT * FROM soldiers WHERE unit_id=?", (1,)),
+    "retrieve_units_by_parent": ("SELECT * FROM units WHERE parent_unit_id=?", (1,)),
+    "get_unit_stats": ("SELECT * FROM unit_stats WHERE unit_id = ?", (1,)),
+    "get_leadership": ("SELECT * FROM soldiers WHERE leadership = 1", ()),
+    "get_awards_by_soldier": (SOLDIER_AWARDS_SELECT, (1,)),
+    "get_demerits_for_soldier": ("""
+        SELECT s.id, s.name, d.id, d.demerit_name, d.demerit_description, d.demerit_signature
+        FROM soldier_demerits sd
+        JOIN demerits d ON sd.demerit_id = d.id
+        JOIN soldiers s ON sd.soldier_id = s.id
+        WHERE sd.soldier_id = ?
+    """, (1,)),
+}
+
+
 class MilitaryDatabase:
-    def __init__(self, db_name):
-        self.conn = sqlite3.connect(db_name)
+    # Writes always go through self.conn. Reads go through self.read_conn, which
+    # comes from read_pool (read-only connections) when one is given and is the
+    # same connection as self.conn otherwise. Pooled connections are only taken
+    # when first used, so a read-only request never holds the writer.
+    def __init__(self, db_name, pool=None, read_pool=None, profile=None):
+        self.pool = pool
+        self.read_pool = read_pool
+        self.cache = get_query_cache(db_name)
+        self._conn = None
+        self._read_conn = None
+        self._closed = False
+        if pool is None:
+            self._conn = connect(db_name, profile)
+
+    @property
+    def conn(self):
+        if self._closed:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        if self._conn is None:
+            self._conn = self.pool.acquire()
+        return self._conn
+
+    @property
+    def read_conn(self):
+        if self.read_pool is None:
+            return self.conn
+        if self._closed:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        if self._read_conn is None:
+            self._read_conn = self.read_pool.acquire()
+        return self._read_conn
 
     def create_tables(self):
         with self.conn:
@@ -86,73 +733,491 @@ class MilitaryDatabase:
                    soldier_id INTEGER NOT NULL,
                    demerit_id INTEGER NOT NULL,
                    demerit_date DATE,
-                   PRIMARY KEY (soldier_id, demerit_id),
                    FOREIGN KEY (soldier_id) REFERENCES soldiers (id),
                    FOREIGN KEY (demerit_id) REFERENCES demerits (id)
                )
            """)
 
-    # Solider Functions
-    def retrieve_all_soldiers(self):
+            # Unit hierarchy closure table, one row per (ancestor, descendant) pair
+            self.conn.execute("""
+               CREATE TABLE IF NOT EXISTS unit_closure (
+                   ancestor_id INTEGER NOT NULL,
+                   descendant_id INTEGER NOT NULL,
+                   depth INTEGER NOT NULL,
+                   PRIMARY KEY (ancestor_id, descendant_id),
+                   FOREIGN KEY (ancestor_id) REFERENCES units (id),
+                   FOREIGN KEY (descendant_id) REFERENCES units (id)
+               )
+           """)
+
+            # Subtree totals per unit, see UNIT_STATS_ADJUST
+            self.conn.execute("""
+               CREATE TABLE IF NOT EXISTS unit_stats (
+                   unit_id INTEGER PRIMARY KEY,
+                   headcount INTEGER NOT NULL DEFAULT 0,
+                   leaders INTEGER NOT NULL DEFAULT 0,
+                   awards INTEGER NOT NULL DEFAULT 0,
+                   demerits INTEGER NOT NULL DEFAULT 0,
+                   ranks TEXT NOT NULL DEFAULT '{}',
+                   aits TEXT NOT NULL DEFAULT '{}',
+                   FOREIGN KEY (unit_id) REFERENCES units (id)
+               )
+           """)
+
+            # Remote award image URL -> name in the local image store (awardImages.ImageStore)
+            self.conn.execute("""
+               CREATE TABLE IF NOT EXISTS award_images (
+                   url TEXT PRIMARY KEY,
+                   name TEXT NOT NULL
+               )
+           """)
+
+            # Next free id per table, see allocate_ids
+            self.conn.execute("""
+               CREATE TABLE IF NOT EXISTS id_sequences (
+                   name TEXT PRIMARY KEY,
+                   next_id INTEGER NOT NULL
+               )
+           """)
+
+        create_data_version(self.conn)
+        self.migrate_schema()
+        self.create_search_index()
+
+        # Databases created before the closure table existed get it filled once
+        closure_empty = self.conn.execute("SELECT NOT EXISTS (SELECT 1 FROM unit_closure)").fetchone()[0]
+        units_exist = self.conn.execute("SELECT EXISTS (SELECT 1 FROM units)").fetchone()[0]
+        if closure_empty and units_exist:
+            self.rebuild_unit_closure()
+
+        stats_empty = self.conn.execute("SELECT NOT EXISTS (SELECT 1 FROM unit_stats)").fetchone()[0]
+        if stats_empty and units_exist:
+            self.refresh_unit_stats()
+
+    # Full-text search
+    def create_search_index(self):
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(soldiers)")}
+        if "country" not in columns:
+            # The older 29th.db / 29test.db soldiers tables have no country column to index
+            return
+        with self.conn:
+            exists = self.conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'soldiers_fts'").fetchone()
+            for statement in SOLDIER_SEARCH_SCHEMA:
+                self.conn.execute(statement)
+            if not exists:
+                # Index the soldiers that were there before the search table
+                self.conn.execute("INSERT INTO soldiers_fts (soldiers_fts) VALUES ('rebuild')")
+
+    def has_search_index(self):
+        # False for databases create_search_index skipped (no country column)
+        with self.read_conn:
+            return self.read_conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'soldiers_fts'").fetchone() is not None
+
+    def search_soldiers(self, text, limit=20, offset=0):
+        # Best bm25 matches first; name hits weigh more than the other columns.
+        # Check has_search_index first on databases that may predate the index.
+        match = search_match_expression(text)
+        if match is None:
+            return []
+        with self.read_conn:
+            cur = self.read_conn.cursor()
+            cur.execute("""
+                SELECT s.*
+                FROM soldiers_fts
+                JOIN soldiers s ON s.id = soldiers_fts.rowid
+                WHERE soldiers_fts MATCH ?
+                ORDER BY bm25(soldiers_fts, 10.0, 1.0, 2.0, 2.0, 2.0)
+                LIMIT ? OFFSET ?
+            """, (match, limit, offset))
+            return fetch_records(cur, "Soldier")
+
+    # Schema migrations and index management
+    def get_schema_version(self):
+        return self.conn.execute("PRAGMA user_version").fetchone()[0]
+
+    def migrate_schema(self, target_version=None):
+        if target_version is None:
+            target_version = len(SCHEMA_MIGRATIONS)
+        version = self.get_schema_version()
+        if version >= target_version:
+            return version
+
+        # One transaction per version, user_version included. The explicit
+        # BEGIN matters: sqlite3 only opens transactions before DML by itself,
+        # so CREATE / ALTER would otherwise commit on their own and a failed
+        # migration would leave a half-changed schema at the old version.
+        for next_version in range(version + 1, target_version + 1):
+            with self.conn:
+                self.conn.execute("BEGIN IMMEDIATE")
+                # Another connection may have migrated while we waited for the lock
+                if self.get_schema_version() >= next_version:
+                    continue
+                for statement in SCHEMA_MIGRATIONS[next_version - 1]:
+                    self.conn.execute(statement)
+                self.conn.execute(f"PRAGMA user_version = {int(next_version)}")
+        self.conn.execute("ANALYZE")
+        return target_version
+
+    def add_index(self, name, table, columns, where=None):
+        sql = f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"
+        if where:
+            sql += f" WHERE {where}"
+        with self.conn:
+            self.conn.execute(sql)
+
+    def drop_index(self, name):
+        with self.conn:
+            self.conn.execute(f"DROP INDEX IF EXISTS {name}")
+
+    def list_indexes(self):
         with self.conn:
             cur = self.conn.cursor()
-            cur.execute("SELECT * FROM soldiers")
+            cur.execute("SELECT name, tbl_name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL")
             return cur.fetchall()
 
+    def explain_query(self, query, params=()):
+        cur = self.conn.cursor()
+        cur.execute("EXPLAIN QUERY PLAN " + query, params)
+        return [row[3] for row in cur.fetchall()]
+
+    def check_query_plans(self):
+        # Returns {query name: plan} for every hot query that scans a table without an index
+        full_scans = {}
+        for name, (query, params) in HOT_QUERIES.items():
+            plan = self.explain_query(query, params)
+            if any(step.startswith("SCAN") and "INDEX" not in step for step in plan):
+                full_scans[name] = plan
+        return full_scans
+
+    def _changed(self, cur, *tables):
+        # Called inside every write's transaction, only when it changed rows, so
+        # the version bump commits or rolls back with the write itself. Cache
+        # keys are named after their table.
+        cur.execute("UPDATE data_version SET version = version + 1")
+        self.cache.invalidate(*tables)
+
+    def get_data_version(self):
+        with self.read_conn:
+            return read_data_version(self.read_conn)
+
+    def _cached(self, key, loader):
+        self.cache.sync(self.get_data_version())
+        return self.cache.get_or_load(key, loader)
+
+    # Solider Functions
+    def retrieve_all_soldiers(self):
+        with self.read_conn:
+            cur = self.read_conn.cursor()
+            cur.execute("SELECT * FROM soldiers")
+            return fetch_records(cur, "Soldier")
+
+    def retrieve_soldiers_page(self, after_id=0, limit=100):
+        with self.read_conn:
+            cur = self.read_conn.cursor()
+            cur.execute("SELECT * FROM soldiers WHERE id > ? ORDER BY id LIMIT ?", (after_id, limit))
+            return fetch_records(cur, "Soldier")
+
+    def iter_soldiers(self, batch_size=500):
+        # Streams rows straight from the cursor without building the full list
+        cur = self.read_conn.cursor()
+        cur.execute("SELECT * FROM soldiers ORDER BY id")
+        soldier = record_type("Soldier", tuple(column[0] for column in cur.description))
+        try:
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from map(soldier._make, rows)
+        finally:
+            cur.close()
+
     def retrieve_units_by_parent(self, parent_unit_id):
-        with self.conn:
-            cur = self.conn.cursor()
+        with self.read_conn:
+            cur = self.read_conn.cursor()
             cur.execute("SELECT * FROM units WHERE parent_unit_id=?", (parent_unit_id,))
-            return cur.fetchall()
+            return fetch_records(cur, "Unit")
 
-    def add_soldier(self, name, age, country, address, rank, ait, unit_id, leadership):
+    def add_soldier(self, name, age, country, address, rank, ait, unit_id, leadership, soldier_id=None):
+        # soldier_id is one reserved earlier with allocate_ids; a new one is taken otherwise
         with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
             cur = self.conn.cursor()
-            # Fix the mismatch order and remove the extra comma
+            if soldier_id is None:
+                soldier_id = self._allocate_ids(cur, "soldiers", 1)[0]
             cur.execute(
-                "INSERT INTO soldiers (name, age, country, address, rank, ait, unit_id, leadership) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                (name, age, country, address, rank, ait, unit_id, int(leadership))
+                "INSERT INTO soldiers (id, name, age, country, address, rank, ait, unit_id, leadership) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (soldier_id, name, age, country, address, rank, ait, unit_id, int(leadership or 0))
             )
-            return cur.lastrowid
+            self._adjust_unit_stats(cur, soldier_stats_deltas([(unit_id, rank, ait, leadership)]))
+            self._changed(cur, "soldiers", "unit_stats")
+        return soldier_id
+
+    def add_soldiers_bulk(self, soldiers):
+        rows = [(name, age, country, address, rank, ait, unit_id, int(leadership or 0))
+                for name, age, country, address, rank, ait, unit_id, leadership in soldiers]
+
+        def add_stats(cur, ids):
+            self._adjust_unit_stats(cur, soldier_stats_deltas((row[6], row[4], row[5], row[7]) for row in rows))
+
+        return self._insert_many("soldiers", ["name", "age", "country", "address", "rank", "ait", "unit_id",
+                                              "leadership"], rows, after=add_stats)
 
     def remove_soldier(self, soldier_id):
         with self.conn:
             cur = self.conn.cursor()
+            cur.execute("""
+                SELECT unit_id, rank, ait, leadership,
+                       (SELECT COUNT(*) FROM soldier_awards WHERE soldier_id = s.id),
+                       (SELECT COUNT(*) FROM soldier_demerits WHERE soldier_id = s.id)
+                FROM soldiers s WHERE id = ?
+            """, (soldier_id,))
+            row = cur.fetchone()
             cur.execute("DELETE FROM soldiers WHERE id=?", (soldier_id,))
+            if row is not None:
+                # The soldier's awards and demerits stop counting once the soldier is gone
+                unit_id, rank, ait, leadership, awards, demerits = row
+                self._adjust_unit_stats(cur, [unit_stats_delta(unit_id, -1, -1 if leadership else 0, -awards,
+                                                               -demerits, rank, ait)])
+                self._changed(cur, "soldiers", "unit_stats")
 
     def get_leadership(self):
-        with self.conn:
-            cur = self.conn.cursor()
+        with self.read_conn:
+            cur = self.read_conn.cursor()
             cur.execute("SELECT * FROM soldiers WHERE leadership = 1")
-            return cur.fetchall()
+            return fetch_records(cur, "Soldier")
 
     # Units functions
     def add_unit(self, name, unit_type, image, parent_unit_id=None):
         with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
             cur = self.conn.cursor()
+            unit_id = self._allocate_ids(cur, "units", 1)[0]
             cur.execute(
-                "INSERT INTO units (name, type, image, parent_unit_id) VALUES (?, ?, ?, ?)",
-                (name, unit_type, image, parent_unit_id))
-            return cur.lastrowid
+                "INSERT INTO units (id, name, type, image, parent_unit_id) VALUES (?, ?, ?, ?, ?)",
+                (unit_id, name, unit_type, image, parent_unit_id))
+            cur.execute(CLOSURE_INSERT, (unit_id, parent_unit_id))
+            cur.execute("INSERT INTO unit_stats (unit_id) VALUES (?)", (unit_id,))
+            self._changed(cur, "units", "unit_stats")
+        return unit_id
+
+    def add_units_bulk(self, units):
+        # Each unit is (name, unit_type, image) or (name, unit_type, image, parent_unit_id)
+        rows = [tuple(unit) if len(unit) == 4 else tuple(unit) + (None,) for unit in units]
+
+        def add_closure(cur, ids):
+            cur.executemany(CLOSURE_INSERT, [(unit_id, row[3]) for unit_id, row in zip(ids, rows)])
+            cur.executemany("INSERT INTO unit_stats (unit_id) VALUES (?)", [(unit_id,) for unit_id in ids])
+
+        return self._insert_many("units", ["name", "type", "image", "parent_unit_id"], rows, after=add_closure)
+
+    def move_unit(self, unit_id, new_parent_id):
+        with self.conn:
+            cur = self.conn.cursor()
+            if new_parent_id is not None:
+                cur.execute("SELECT 1 FROM unit_closure WHERE ancestor_id = ? AND descendant_id = ?",
+                            (unit_id, new_parent_id))
+                if cur.fetchone():
+                    raise ValueError(f"Unit {new_parent_id} is inside unit {unit_id}'s subtree")
+
+            ancestors_query = "SELECT ancestor_id FROM unit_closure WHERE descendant_id = ? AND depth > 0"
+            old_ancestors = [row[0] for row in cur.execute(ancestors_query, (unit_id,))]
+
+            # Detach the subtree from its old ancestors, then hang it under the new parent
+            cur.execute("""
+                DELETE FROM unit_closure
+                WHERE descendant_id IN (SELECT descendant_id FROM unit_closure WHERE ancestor_id = ?1)
+                  AND ancestor_id NOT IN (SELECT descendant_id FROM unit_closure WHERE ancestor_id = ?1)
+            """, (unit_id,))
+            if new_parent_id is not None:
+                cur.execute("""
+                    INSERT INTO unit_closure (ancestor_id, descendant_id, depth)
+                    SELECT above.ancestor_id, below.descendant_id, above.depth + below.depth + 1
+                    FROM unit_closure above, unit_closure below
+                    WHERE above.descendant_id = ? AND below.ancestor_id = ?
+                """, (new_parent_id, unit_id))
+            cur.execute("UPDATE units SET parent_unit_id = ? WHERE id = ?", (new_parent_id, unit_id))
+
+            # The moved subtree keeps its own totals; only the old and new ancestors change
+            new_ancestors = [row[0] for row in cur.execute(ancestors_query, (unit_id,))]
+            self._refresh_unit_stats(cur, old_ancestors + new_ancestors)
+            self._changed(cur, "units", "unit_stats")
+
+    def rebuild_unit_closure(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM unit_closure")
+            self.conn.execute("""
+                INSERT INTO unit_closure (ancestor_id, descendant_id, depth)
+                WITH RECURSIVE closure(ancestor_id, descendant_id, depth) AS (
+                    SELECT id, id, 0 FROM units
+                    UNION ALL
+                    SELECT c.ancestor_id, u.id, c.depth + 1
+                    FROM units u
+                    JOIN closure c ON u.parent_unit_id = c.descendant_id
+                )
+                SELECT ancestor_id, descendant_id, depth FROM closure
+            """)
+            self._changed(self.conn, "unit_closure")
+
+    # Unit statistics
+    def _adjust_unit_stats(self, cur, deltas):
+        cur.executemany(UNIT_STATS_ADJUST, deltas)
+
+    def _adjust_soldier_stats(self, cur, soldier_id, awards=0, demerits=0):
+        cur.execute("SELECT unit_id FROM soldiers WHERE id = ?", (soldier_id,))
+        row = cur.fetchone()
+        if row is not None:
+            self._adjust_unit_stats(cur, [unit_stats_delta(row[0], awards=awards, demerits=demerits)])
+
+    def _refresh_unit_stats(self, cur, unit_ids=None):
+        if unit_ids is not None:
+            if not unit_ids:
+                return
+            unit_ids = json.dumps(list(unit_ids))
+        cur.execute(UNIT_STATS_REFRESH, (unit_ids,))
+
+    def refresh_unit_stats(self, unit_ids=None):
+        # Recomputes unit_stats from the base tables, for all units by default.
+        # Use after writing soldiers, awards or demerits with raw SQL.
+        with self.conn:
+            self._refresh_unit_stats(self.conn.cursor(), unit_ids)
+            self._changed(self.conn, "unit_stats")
+
+    def get_unit_stats(self, unit_id):
+        with self.read_conn:
+            cur = self.read_conn.cursor()
+            cur.execute("SELECT * FROM unit_stats WHERE unit_id = ?", (unit_id,))
+            row = cur.fetchone()
+            if row is None:
+                return None
+            stats = dict(zip([column[0] for column in cur.description], row))
+            stats["ranks"] = json.loads(stats["ranks"])
+            stats["aits"] = json.loads(stats["aits"])
+            return stats
+
+    def get_unit_ancestors(self, unit_id):
+        with self.read_conn:
+            cur = self.read_conn.cursor()
+            cur.execute("""
+                SELECT u.id, u.name, u.type, u.image, u.parent_unit_id, c.depth
+                FROM unit_closure c
+                JOIN units u ON u.id = c.ancestor_id
+                WHERE c.descendant_id = ? AND c.depth > 0
+                ORDER BY c.depth
+            """, (unit_id,))
+            return fetch_records(cur, "Unit")
+
+    def get_ancestor_of_type(self, unit_id, unit_type):
+        with self.read_conn:
+            cur = self.read_conn.cursor()
+            cur.execute("""
+                SELECT u.id, u.name, u.type, u.image, u.parent_unit_id
+                FROM unit_closure c
+                JOIN units u ON u.id = c.ancestor_id
+                WHERE c.descendant_id = ? AND u.type = ?
+                ORDER BY c.depth
+                LIMIT 1
+            """, (unit_id, unit_type))
+            units = fetch_records(cur, "Unit")
+            return units[0] if units else None
+
+    def get_soldiers_under_unit(self, unit_id):
+        with self.read_conn:
+            cur = self.read_conn.cursor()
+            cur.execute("""
+                SELECT s.*
+                FROM unit_closure c
+                JOIN soldiers s ON s.unit_id = c.descendant_id
+                WHERE c.ancestor_id = ?
+                ORDER BY s.id
+            """, (unit_id,))
+            return fetch_records(cur, "Soldier")
+
+    def _unit_soldier_ids(self, cur, unit_id, recursive=True):
+        if recursive:
+            cur.execute("""
+                SELECT s.id FROM unit_closure c JOIN soldiers s ON s.unit_id = c.descendant_id
+                WHERE c.ancestor_id = ? ORDER BY s.id
+            """, (unit_id,))
+        else:
+            cur.execute("SELECT id FROM soldiers WHERE unit_id = ? ORDER BY id", (unit_id,))
+        return [row[0] for row in cur.fetchall()]
+
+    def _soldier_units(self, cur, soldier_ids):
+        # {soldier_id: unit_id} for the soldiers that exist
+        cur.execute("SELECT id, unit_id FROM soldiers WHERE id IN (SELECT value FROM json_each(?))",
+                    (json.dumps(list(soldier_ids)),))
+        return dict(cur.fetchall())
 
     def assign_soldier_to_unit(self, soldier_id, unit_id):
         with self.conn:
             self.conn.execute("INSERT INTO soldier_units (soldier_id, unit_id) VALUES (?, ?)",
                               (soldier_id, unit_id))
+            self._changed(self.conn, "soldier_units")
 
-    def retrieve_all_units(self):
+    def assign_bulk(self, assignments):
         with self.conn:
             cur = self.conn.cursor()
+            cur.executemany("INSERT INTO soldier_units (soldier_id, unit_id) VALUES (?, ?)", assignments)
+            count = cur.rowcount
+            if count:
+                self._changed(cur, "soldier_units")
+        return count
+
+    def retrieve_all_units(self):
+        return self._cached("units", self._load_all_units)
+
+    def _load_all_units(self):
+        with self.read_conn:
+            cur = self.read_conn.cursor()
             cur.execute("SELECT id, name FROM units")
-            units = [dict(zip(["id", "name", "image"], row)) for row in cur.fetchall()]
+            units = [dict(zip(["id", "name"], row)) for row in cur.fetchall()]
             return units
 
-    def get_soldiers_by_unit(self, unit_id):
-        with self.conn:
-            cur = self.conn.cursor()
-            cur.execute("SELECT * FROM soldiers WHERE unit_id=?", (unit_id,))
-            return [dict(zip(["id", "name", "age","country", "address", "rank", "ait", "unit_id"], row)) for row in
-                    cur.fetchall()]
+    def get_unit_subtree(self, unit_id, include_soldiers=False):
+        with self.read_conn:
+            cur = self.read_conn.cursor()
+            soldier_count = ", (SELECT COUNT(*) FROM soldiers s WHERE s.unit_id = st.id)" if include_soldiers else ""
+            query = f"""
+            WITH RECURSIVE subtree(id, name, type, image, parent_unit_id, depth) AS (
+                SELECT id, name, type, image, parent_unit_id, 0 FROM units WHERE id = ?
+                UNION ALL
+                SELECT u.id, u.name, u.type, u.image, u.parent_unit_id, st.depth + 1
+                FROM units u
+                JOIN subtree st ON u.parent_unit_id = st.id
+            )
+            SELECT st.id, st.name, st.type, st.image, st.parent_unit_id, st.depth{soldier_count}
+            FROM subtree st
+            ORDER BY st.depth, st.id
+            """
+            cur.execute(query, (unit_id,))
+            rows = cur.fetchall()
+
+        # Rows come back parents first, so every child finds its parent already built
+        nodes = {}
+        root = None
+        for row in rows:
+            node = dict(zip(["id", "name", "type", "image", "parent_unit_id", "depth"], row))
+            if include_soldiers:
+                node['soldier_count'] = row[6]
+            node['children'] = []
+            nodes[node['id']] = node
+            if root is None:
+                root = node
+            else:
+                nodes[node['parent_unit_id']]['children'].append(node)
+
+        if include_soldiers and root is not None:
+            self._add_subtree_totals(root)
+        return root
+
+    def _add_subtree_totals(self, node):
+        total = node['soldier_count']
+        for child in node['children']:
+            total += self._add_subtree_totals(child)
+        node['total_soldier_count'] = total
+        return total
 
     def update_unit_image(self, unit_id, new_image):
         with self.conn:
@@ -160,12 +1225,33 @@ class MilitaryDatabase:
             cur.execute(
                 "UPDATE units SET image = ? WHERE id = ?",
                 (new_image, unit_id))
+            if cur.rowcount:
+                self._changed(cur, "units")
 
     def get_soldiers_by_unit(self, unit_id):
-        with self.conn:
-            cur = self.conn.cursor()
+        with self.read_conn:
+            cur = self.read_conn.cursor()
             cur.execute("SELECT * FROM soldiers WHERE unit_id=?", (unit_id,))
-            return cur.fetchall()
+            return fetch_records(cur, "Soldier")
+
+    def retrieve_units_with_soldiers(self):
+        with self.read_conn:
+            cur = self.read_conn.cursor()
+            cur.execute("SELECT id, name FROM units")
+            units = [dict(zip(["id", "name"], row)) for row in cur.fetchall()]
+
+            # Group every assigned soldier under its unit in a single pass
+            units_by_id = {}
+            for unit in units:
+                unit['soldiers'] = []
+                units_by_id[unit['id']] = unit
+
+            cur.execute("SELECT * FROM soldiers WHERE unit_id IS NOT NULL ORDER BY id")
+            for soldier in fetch_records(cur, "Soldier"):
+                unit = units_by_id.get(soldier.unit_id)
+                if unit is not None:
+                    unit['soldiers'].append(soldier)
+            return units
 
     # Award Functions
     def add_award_to_soldier(self, soldier_id, award_id, ):
@@ -176,6 +1262,8 @@ class MilitaryDatabase:
             cur.execute(
                 "INSERT INTO soldier_awards (soldier_id, award_id, award_date) VALUES (?, ?, ?)",
                 (soldier_id, award_id, now))
+            self._adjust_soldier_stats(cur, soldier_id, awards=1)
+            self._changed(cur, "soldier_awards", "unit_stats")
 
     def remove_award_from_soldier(self, soldier_id, award_id):
         with self.conn:
@@ -183,65 +1271,281 @@ class MilitaryDatabase:
             cur.execute(
                 "DELETE FROM soldier_awards WHERE soldier_id = ? AND award_id = ?",
                 (soldier_id, award_id))
-
-    def get_all_awards(self):
+            if cur.rowcount:
+                self._adjust_soldier_stats(cur, soldier_id, awards=-1)
+                self._changed(cur, "soldier_awards", "unit_stats")
+
+    def _award_stats(self, cur, soldier_ids):
+        per_unit = {}
+        for unit_id in self._soldier_units(cur, soldier_ids).values():
+            if unit_id is not None:
+                per_unit[unit_id] = per_unit.get(unit_id, 0) + 1
+        self._adjust_unit_stats(cur, [unit_stats_delta(unit_id, awards=count) for unit_id, count in per_unit.items()])
+
+    def _grant_award_to_unit(self, cur, unit_id, award_id, recursive, award_date):
+        cur.execute(UNIT_AWARD_GRANT, (unit_id, award_id, award_date, bool(recursive)))
+        granted = [row[0] for row in cur.fetchall()]
+        self._award_stats(cur, granted)
+        return granted
+
+    def grant_award_to_unit(self, unit_id, award_id, recursive=True):
+        # Grants award_id to every soldier of unit_id, and of its subunits when
+        # recursive, with one INSERT ... SELECT over unit_closure. Returns the
+        # ids of the soldiers who were granted it; those who already held it
+        # are left alone.
+        now = datetime.now().strftime("%m/%d/%Y, %H:%M:%S")
         with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
             cur = self.conn.cursor()
-            cur.execute("SELECT * FROM awards")
-            return cur.fetchall()
-
-    def get_awards_by_soldier(self, soldier_id):
+            cur.execute("SELECT 1 FROM awards WHERE id = ?", (award_id,))
+            if cur.fetchone() is None:
+                raise ValueError(f"Award {award_id} does not exist")
+            granted = self._grant_award_to_unit(cur, unit_id, award_id, recursive, now)
+            if granted:
+                self._changed(cur, "soldier_awards", "unit_stats")
+        return granted
+
+    def grant_awards(self, grants=(), unit_id=None, award_id=None, recursive=True):
+        # Grants (soldier_id, award_id) pairs, then award_id to every soldier of
+        # unit_id (and its subunits when recursive), in one transaction.
+        # Returns one {"soldier_id", "award_id", "status"} per grant, status
+        # being granted, already_awarded, unknown_soldier or unknown_award.
+        now = datetime.now().strftime("%m/%d/%Y, %H:%M:%S")
         with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
             cur = self.conn.cursor()
+            grants = [tuple(grant) for grant in grants]
+            units = self._soldier_units(cur, {soldier_id for soldier_id, _ in grants})
+            cur.execute("SELECT id FROM awards WHERE id IN (SELECT value FROM json_each(?))",
+                        (json.dumps(list({grant[1] for grant in grants} | {award_id})),))
+            known_awards = {row[0] for row in cur.fetchall()}
+            cur.execute("""
+                SELECT soldier_id, award_id FROM soldier_awards
+                WHERE (soldier_id, award_id) IN (SELECT value ->> 0, value ->> 1 FROM json_each(?))
+            """, (json.dumps(grants),))
+            held = set(cur.fetchall())
+
+            results, rows = [], []
+            for soldier_id, grant_award_id in grants:
+                if soldier_id not in units:
+                    status = "unknown_soldier"
+                elif grant_award_id not in known_awards:
+                    status = "unknown_award"
+                elif (soldier_id, grant_award_id) in held:
+                    status = "already_awarded"
+                else:
+                    status = "granted"
+                    held.add((soldier_id, grant_award_id))
+                    rows.append((soldier_id, grant_award_id, now))
+                results.append({"soldier_id": soldier_id, "award_id": grant_award_id, "status": status})
+            cur.executemany("INSERT INTO soldier_awards (soldier_id, award_id, award_date) VALUES (?, ?, ?)", rows)
+            self._award_stats(cur, [row[0] for row in rows])
+
+            granted = set()
+            if unit_id is not None:
+                if award_id in known_awards:
+                    granted = set(self._grant_award_to_unit(cur, unit_id, award_id, recursive, now))
+                status = "already_awarded" if award_id in known_awards else "unknown_award"
+                results += [{"soldier_id": soldier_id, "award_id": award_id,
+                             "status": "granted" if soldier_id in granted else status}
+                            for soldier_id in self._unit_soldier_ids(cur, unit_id, recursive)]
+            if rows or granted:
+                self._changed(cur, "soldier_awards", "unit_stats")
+        return results
 
-            # Use a JOIN to get award details
-            query = """
-            SELECT a.award_name, a.award_description, a.award_image_bg, a.award_image_sm
-            FROM soldier_awards sa
-            JOIN awards a ON sa.award_id = a.id
-            WHERE sa.soldier_id = ?
-            """
+    def get_all_awards(self):
+        return self._cached("awards", self._load_all_awards)
 
-            cur.execute(query, (soldier_id,))
-            return cur.fetchall()
+    def _load_all_awards(self):
+        with self.read_conn:
+            cur = self.read_conn.cursor()
+            cur.execute(AWARD_SELECT)
+            return fetch_records(cur, "Award")
+
+    def get_awards_by_soldier(self, soldier_id):
+        with self.read_conn:
+            cur = self.read_conn.cursor()
+            cur.execute(SOLDIER_AWARDS_SELECT, (soldier_id,))
+            return fetch_records(cur, "Award")
 
     def create_award(self, award_name, award_desc, award_image_bg, award_image_sm):
+        award = (award_name, award_desc, award_image_bg, award_image_sm)
         with self.conn:
             cur = self.conn.cursor()
             cur.execute(
-                "INSERT INTO awards (award_name ,award_description , award_image_bg, award_image_sm) VALUES (?, ?, ?, ?)",
-                (award_name, award_desc, award_image_bg, award_image_sm))
-            return cur.lastrowid
+                "INSERT INTO awards (award_name ,award_description , award_image_bg, award_image_sm, content_hash) VALUES (?, ?, ?, ?, ?)",
+                award + (award_content_hash(award),))
+            award_id = cur.lastrowid
+            self._changed(cur, "awards")
+        return award_id
+
+    def create_awards_bulk(self, awards):
+        return self._insert_many("awards", AWARD_COLUMNS + ["content_hash"],
+                                 [tuple(award[:4]) + (award_content_hash(award),) for award in awards])
+
+    def record_award_images(self, images):
+        # images is {remote url: stored name} from awardScraper.mirror_award_images
+        if not images:
+            return
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO award_images (url, name) VALUES (?, ?)", images.items())
+            self._changed(self.conn, "awards")
+
+    def sync_awards(self, awards, prune=False):
+        # Makes the awards table match a scraped catalog (award_info records or
+        # [name, description, image_bg, image_sm] lists) in one transaction.
+        # Awards are matched by name and rewritten only when their hash changed.
+        # With prune, awards missing from the catalog are deleted unless a
+        # soldier holds them.
+        catalog = {}
+        for award in awards:
+            catalog[award[0]] = tuple(award[:4])
+        result = {"inserted": 0, "updated": 0, "unchanged": 0, "removed": 0}
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            cur = self.conn.cursor()
+            cur.execute("SELECT award_name, content_hash FROM awards")
+            existing = dict(cur.fetchall())
+            changed = []
+            for name, award in catalog.items():
+                content_hash = award_content_hash(award)
+                if name not in existing:
+                    result["inserted"] += 1
+                elif existing[name] != content_hash:
+                    result["updated"] += 1
+                else:
+                    result["unchanged"] += 1
+                    continue
+                changed.append([name, award, content_hash])
+            new_ids = iter(self._allocate_ids(cur, "awards", result["inserted"]) if result["inserted"] else ())
+            rows = [(next(new_ids) if name not in existing else None,) + award + (content_hash,)
+                    for name, award, content_hash in changed]
+            if rows:
+                cur.execute(AWARD_UPSERT, (json.dumps(rows),))
+            if prune:
+                missing = [name for name in existing if name not in catalog]
+                cur.execute("""
+                    DELETE FROM awards
+                    WHERE award_name IN (SELECT value FROM json_each(?))
+                      AND NOT EXISTS (SELECT 1 FROM soldier_awards WHERE award_id = awards.id)
+                """, (json.dumps(missing),))
+                result["removed"] = cur.rowcount
+            if rows or result["removed"]:
+                self._changed(cur, "awards")
+        return result
+
+    # Id allocation
+    def _allocate_ids(self, cur, table, count):
+        # Must run inside a write transaction. Starting past MAX(id) as well
+        # keeps rows that were inserted without the sequence from colliding.
+        cur.execute(f"""
+            SELECT MAX(COALESCE((SELECT next_id FROM id_sequences WHERE name = ?), 1),
+                       (SELECT COALESCE(MAX(id), 0) + 1 FROM {table}))
+        """, (table,))
+        first_id = cur.fetchone()[0]
+        cur.execute("INSERT OR REPLACE INTO id_sequences (name, next_id) VALUES (?, ?)", (table, first_id + count))
+        return range(first_id, first_id + count)
+
+    def allocate_ids(self, table, count=1):
+        # Reserves count ids in table for the caller. The reservation is
+        # committed under the database write lock, so no other thread or
+        # process will be handed the same ids even if they are never used.
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            return self._allocate_ids(self.conn.cursor(), table, count)
+
+    # Bulk helpers
+    def _insert_many(self, table, columns, rows, after=None):
+        # Ids are handed out explicitly while holding the write lock, so the
+        # caller gets them back without one lastrowid round-trip per row
+        if not rows:
+            return []
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            cur = self.conn.cursor()
+            ids = list(self._allocate_ids(cur, table, len(rows)))
+            insert_rows(cur, table, ["id"] + list(columns),
+                        [(row_id,) + tuple(row) for row_id, row in zip(ids, rows)])
+            if after is not None:
+                after(cur, ids)
+            self._changed(cur, table)
+        return ids
 
     # Demerit Functions
 
     from datetime import datetime
 
     def add_demerit_to_soldier(self, soldier_id, demerit_name, demerit_description=None, demerit_signature=None):
-        with self.conn:
-            cur = self.conn.cursor()
-            cur.execute(
-                "INSERT INTO demerits (demerit_name, demerit_description, demerit_signature) VALUES (?, ?, ?)",
-                (demerit_name, demerit_description, demerit_signature))
-            demerit_id = cur.lastrowid
+        # Returns the demerit type's id
+        result = self.add_demerits_bulk([(soldier_id, demerit_name, demerit_description, demerit_signature)])
+        if result[0]["status"] == "unknown_soldier":
+            raise LookupError(f"Soldier {soldier_id} does not exist")
+        return result[0]["demerit_id"]
 
-        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    def remove_demerit_from_soldier(self, soldier_id, demerit_id):
+        # Removes the soldier's most recent demerit of that type
         with self.conn:
             cur = self.conn.cursor()
-            cur.execute(
-                "INSERT INTO soldier_demerits (soldier_id, demerit_id, demerit_date) VALUES (?, ?, ?)",
-                (soldier_id, demerit_id, now))
-
-    def remove_demerit_from_soldier(self, soldier_id, demerit_id):
+            cur.execute("""
+                DELETE FROM soldier_demerits WHERE rowid = (
+                    SELECT rowid FROM soldier_demerits WHERE soldier_id = ? AND demerit_id = ?
+                    ORDER BY demerit_date DESC, rowid DESC LIMIT 1
+                )
+            """, (soldier_id, demerit_id))
+            if cur.rowcount:
+                self._adjust_soldier_stats(cur, soldier_id, demerits=-1)
+                self._changed(cur, "soldier_demerits", "unit_stats")
+
+    def _demerit_type_ids(self, cur, types):
+        # {demerit_type_key: id} for types, adding the ones not in the catalog yet
+        keys = list(dict.fromkeys(demerit_type_key(*demerit_type) for demerit_type in types))
+        cur.execute(DEMERIT_TYPE_SELECT, (json.dumps(keys),))
+        ids = {demerit_type_key(*row[1:]): row[0] for row in cur.fetchall()}
+        missing = [key for key in keys if key not in ids]
+        rows = [(demerit_id, name, description or None, signature)
+                for demerit_id, (name, description, signature)
+                in zip(self._allocate_ids(cur, "demerits", len(missing)), missing)]
+        insert_rows(cur, "demerits", ["id", "demerit_name", "demerit_description", "demerit_signature"], rows)
+        ids.update((demerit_type_key(*row[1:]), row[0]) for row in rows)
+        return ids
+
+    def add_demerits_bulk(self, demerits=(), unit_id=None, demerit=None, recursive=True):
+        # Records (soldier_id, demerit_name, demerit_description, demerit_signature)
+        # items, or one (demerit_name, demerit_description, demerit_signature)
+        # for every soldier of unit_id, in one transaction. Identical demerits
+        # share one demerits row, so a busy day adds soldier_demerits rows and
+        # few or no demerit types. Returns one {"soldier_id", "demerit_id",
+        # "status"} per item, status being added or unknown_soldier.
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
             cur = self.conn.cursor()
-            cur.execute(
-                "DELETE FROM soldier_demerits WHERE soldier_id = ? AND demerit_id = ?",
-                (soldier_id, demerit_id))
+            demerits = [tuple(item) for item in demerits]
+            if unit_id is not None:
+                demerits += [(soldier_id,) + tuple(demerit)
+                             for soldier_id in self._unit_soldier_ids(cur, unit_id, recursive)]
+            units = self._soldier_units(cur, {item[0] for item in demerits})
+            type_ids = self._demerit_type_ids(cur, [item[1:] for item in demerits if item[0] in units])
+
+            results, link_rows, per_unit = [], [], {}
+            for soldier_id, name, description, signature in demerits:
+                if soldier_id not in units:
+                    results.append({"soldier_id": soldier_id, "demerit_id": None, "status": "unknown_soldier"})
+                    continue
+                demerit_id = type_ids[demerit_type_key(name, description, signature)]
+                link_rows.append((soldier_id, demerit_id, now))
+                per_unit[units[soldier_id]] = per_unit.get(units[soldier_id], 0) + 1
+                results.append({"soldier_id": soldier_id, "demerit_id": demerit_id, "status": "added"})
+            insert_rows(cur, "soldier_demerits", ["soldier_id", "demerit_id", "demerit_date"], link_rows)
+            self._adjust_unit_stats(cur, [unit_stats_delta(unit, demerits=count)
+                                          for unit, count in per_unit.items() if unit is not None])
+            if link_rows:
+                self._changed(cur, "demerits", "soldier_demerits", "unit_stats")
+        return results
 
     def get_soldier_demerits(self, soldier_id):
-        with self.conn:
-            cur = self.conn.cursor()
+        with self.read_conn:
+            cur = self.read_conn.cursor()
 
             # Use a JOIN to get demerit details for a specific soldier
             query = """
@@ -252,11 +1556,11 @@ class MilitaryDatabase:
             """
 
             cur.execute(query, (soldier_id,))
-            return cur.fetchall()
+            return fetch_records(cur, "Demerit")
 
-    def get_all_soldier_demerits(self):
-        with self.conn:
-            cur = self.conn.cursor()
+    def get_all_soldier_demerits(self, shape="rows"):
+        with self.read_conn:
+            cur = self.read_conn.cursor()
             query = """
             SELECT s.id as soldier_id, s.name as soldier_name, 
                    d.id as demerit_id, d.demerit_name, d.demerit_description, d.demerit_signature
@@ -265,12 +1569,11 @@ class MilitaryDatabase:
             JOIN soldiers s ON sd.soldier_id = s.id
             """
 
-            cur.execute(query)
-            return cur.fetchall()
+            return fetch_shaped(cur, query, (), shape, "SoldierDemerit")
 
-    def get_demerits_for_soldier(self, soldier_id):
-        with self.conn:
-            cur = self.conn.cursor()
+    def get_demerits_for_soldier(self, soldier_id, shape="rows"):
+        with self.read_conn:
+            cur = self.read_conn.cursor()
 
             query = """
             SELECT s.id as soldier_id, s.name as soldier_name, 
@@ -278,14 +1581,132 @@ class MilitaryDatabase:
             FROM soldier_demerits sd
             JOIN demerits d ON sd.demerit_id = d.id
             JOIN soldiers s ON sd.soldier_id = s.id
-            WHERE s.id = ?
+            WHERE sd.soldier_id = ?
             """
 
-            cur.execute(query, (soldier_id,))
-            return cur.fetchall()
+            return fetch_shaped(cur, query, (soldier_id,), shape, "SoldierDemerit")
+
+    def deferred(self):
+        return UnitOfWork(self)
 
     def close(self):
-        self.conn.close()
+        # Final: a closed database never takes another pooled connection
+        self._closed = True
+        if self._read_conn is not None:
+            self.read_pool.release(self._read_conn)
+            self._read_conn = None
+        if self._conn is not None:
+            if self.pool is not None:
+                self.pool.release(self._conn)
+            else:
+                self._conn.close()
+            self._conn = None
+
+
+class IdAllocator:
+    # Hands out ids one at a time from blocks reserved with
+    # MilitaryDatabase.allocate_ids, so they are unique across threads and
+    # processes sharing the database while costing one write per block.
+    def __init__(self, db, table="soldiers", block_size=256):
+        self.db = db
+        self.table = table
+        self.block_size = block_size
+        self.lock = threading.Lock()
+        self.block = iter(())
+        self.pid = os.getpid()
+
+    def _reserve(self):
+        return self.db.allocate_ids(self.table, self.block_size)
+
+    def next_id(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                # A forked child must not reuse the block its parent is handing out
+                self.pid = os.getpid()
+                self.block = iter(())
+            row_id = next(self.block, None)
+            if row_id is None:
+                self.block = iter(self._reserve())
+                row_id = next(self.block)
+            return row_id
+
+
+class UnitOfWork:
+    # Stands in for MilitaryDatabase when building a unit hierarchy: units and
+    # soldiers get their ids up front and are written in one transaction on flush.
+    #
+    #     with db.deferred() as batch:
+    #         battalion = Battalion("1st Battalion", batch, image)
+    #         company = Company("Easy", batch, image, battalion.id)
+    def __init__(self, db, id_block_size=256):
+        self.db = db
+        self.units = []
+        self.soldiers = []
+        self.id_block_size = id_block_size
+        self._allocators = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+        else:
+            self.discard()
+
+    def _reserve_id(self, table):
+        # Ids come from blocks reserved in the database, so nobody else can
+        # take them before flush; unused ones are left as a gap
+        if table not in self._allocators:
+            self._allocators[table] = IdAllocator(self.db, table, self.id_block_size)
+        return self._allocators[table].next_id()
+
+    def add_unit(self, name, unit_type, image, parent_unit_id=None):
+        unit_id = self._reserve_id("units")
+        self.units.append([unit_id, name, unit_type, image, parent_unit_id])
+        return unit_id
+
+    def add_soldier(self, name, age, country, address, rank, ait, unit_id, leadership, soldier_id=None):
+        if soldier_id is None:
+            soldier_id = self._reserve_id("soldiers")
+        self.soldiers.append((soldier_id, name, age, country, address, rank, ait, unit_id, int(leadership or 0)))
+        return soldier_id
+
+    def update_unit_image(self, unit_id, new_image):
+        for unit in self.units:
+            if unit[0] == unit_id:
+                unit[3] = new_image
+                return
+        self.db.update_unit_image(unit_id, new_image)
+
+    def retrieve_units_by_parent(self, parent_unit_id):
+        unit_record = record_type("Unit", ("id", "name", "type", "image", "parent_unit_id"))
+        pending = [unit_record._make(unit) for unit in self.units if unit[4] == parent_unit_id]
+        return self.db.retrieve_units_by_parent(parent_unit_id) + pending
+
+    def flush(self):
+        if not self.units and not self.soldiers:
+            return
+        conn = self.db.conn
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("INSERT INTO units (id, name, type, image, parent_unit_id) VALUES (?, ?, ?, ?, ?)",
+                             self.units)
+            # Units were queued parents first, so each closure row can build on its parent's
+            conn.executemany(CLOSURE_INSERT, [(unit[0], unit[4]) for unit in self.units])
+            conn.executemany("INSERT INTO unit_stats (unit_id) VALUES (?)", [(unit[0],) for unit in self.units])
+            insert_rows(conn.cursor(), "soldiers",
+                        ["id", "name", "age", "country", "address", "rank", "ait", "unit_id", "leadership"],
+                        self.soldiers)
+            self.db._adjust_unit_stats(conn.cursor(), soldier_stats_deltas(
+                (soldier[7], soldier[5], soldier[6], soldier[8]) for soldier in self.soldiers))
+            self.db._changed(conn, "units", "soldiers", "unit_stats")
+        self.discard()
+
+    def discard(self):
+        self.units = []
+        self.soldiers = []
+        self._allocators = {}
 
 
 class MilitaryUnit:
@@ -300,8 +1721,9 @@ class MilitaryUnit:
 
     def add_soldier(self, soldier):
         self.soldiers.append(soldier)
-        soldier_id = self.db.add_soldier(soldier.name, soldier.age,soldier.country, soldier.address, soldier.rank, soldier.ait, self.id,
-                                         soldier.leadership,)
+        # A profile that already has an id (from ProfileManager) is saved under it
+        soldier.id = self.db.add_soldier(soldier.name, soldier.age,soldier.country, soldier.address, soldier.rank, soldier.ait, self.id,
+                                         soldier.leadership, soldier.id)
 
     def get_subordinate_units(self):
         return self.db.retrieve_units_by_parent(self.id)
@@ -386,7 +1808,7 @@ class Squad(MilitaryUnit):
 
 
 class Profile:
-    def __init__(self, name, age, address, id=random.randint(0, 100000), rank="Private", ait="Rifle", company=None,
+    def __init__(self, name, age, address, id=None, rank="Private", ait="Rifle", company=None,
                  platoon=None, squad=None, battalion=None, leadership=None, awards=None,country=None):
         self.id = id
         self.name = name
@@ -409,65 +1831,141 @@ class Profile:
 
 
 class ProfileManager:
-    def __init__(self, ):
-        self.profiles = []
+    # Profiles are kept by id with hash indexes beside them, so lookups and
+    # deletes never scan. The secondary indexes map a value to a dict of
+    # id -> profile, which keeps insertion order and removes in O(1).
+    def __init__(self, db):
+        # New profiles take their ids from the database's soldiers.id sequence,
+        # and keep them as their soldiers.id when a unit saves them
+        self.db = db
+        self.profiles = {}
+        self.by_name_age = {}
+        self.by_rank = {}
+        self.by_ait = {}
+        self.by_unit = {}
+        self._keys = {}
         self.rankList = ["Private", "Corporal", "Sergeant", "Lieutenant", "Captain", "Major", "Colonel", "General"]
         self.ait = ["Rifle", "CE", "Medic", "GL", "AR"]
 
+    @staticmethod
+    def profile_unit(profile):
+        return profile.squad or profile.platoon or profile.company or profile.battalion
+
+    def _index(self, profile):
+        keys = ((profile.name, profile.age), profile.rank, profile.ait, self.profile_unit(profile))
+        for index, key in zip((self.by_name_age, self.by_rank, self.by_ait, self.by_unit), keys):
+            index.setdefault(key, {})[profile.id] = profile
+        self._keys[profile.id] = keys
+
+    def _unindex(self, profile):
+        # Uses the keys the profile was indexed under, so it works after the profile changed
+        keys = self._keys.pop(profile.id)
+        for index, key in zip((self.by_name_age, self.by_rank, self.by_ait, self.by_unit), keys):
+            bucket = index[key]
+            del bucket[profile.id]
+            if not bucket:
+                del index[key]
+
+    def reindex(self, profile):
+        # Call after changing a profile's name, age, rank, ait or unit directly
+        self._unindex(profile)
+        self._index(profile)
+
     def add_profile(self, profile):
-        profile.id = random.randint(0, 100000)
-        self.profiles.append(profile)
+        self.add_profiles([profile])
+
+    def add_profiles(self, profiles):
+        # Profiles saved to the database already carry their soldiers.id; the
+        # others share one reservation of exactly as many ids as they need
+        profiles = list(profiles)
+        for profile in profiles:
+            if profile.id is not None and profile.id in self.profiles:
+                raise ValueError(f"Profile id {profile.id} is already in use")
+        new = [profile for profile in profiles if profile.id is None]
+        for profile, profile_id in zip(new, self.db.allocate_ids("soldiers", len(new)) if new else ()):
+            profile.id = profile_id
+        for profile in profiles:
+            self.profiles[profile.id] = profile
+            self._index(profile)
 
     def get_profiles(self, ):
-        for i in self.profiles:
+        for i in self.profiles.values():
             print(i)
 
+    def get_profile(self, profile_id):
+        return self.profiles.get(profile_id)
+
+    def find_profile(self, name, age):
+        for i in self.by_name_age.get((name, age), {}).values():
+            return i
+
+    def find_by_rank(self, rank):
+        return list(self.by_rank.get(rank, {}).values())
+
+    def find_by_ait(self, ait):
+        return list(self.by_ait.get(ait, {}).values())
+
+    def find_by_unit(self, unit):
+        return list(self.by_unit.get(unit, {}).values())
+
     def search_profile(self, name, age):
-        for i in self.profiles:
-            if i.name == name and i.age == age:
-                print("Profile found")
-                return i
+        i = self.find_profile(name, age)
+        if i is not None:
+            print("Profile found")
+        return i
+
+    def remove_profile(self, profile_id):
+        profile = self.profiles.pop(profile_id, None)
+        if profile is not None:
+            self._unindex(profile)
+        return profile
 
     def delete_profile(self, name, age):
-        for i in self.profiles:
-            if i.name == name and i.age == age:
-                self.profiles.remove(i)
-                break
+        i = self.find_profile(name, age)
+        if i is not None:
+            self.remove_profile(i.id)
+
+    def set_rank(self, profile, rank):
+        profile.rank = rank
+        self.reindex(profile)
+
+    def set_ait(self, profile, ait):
+        profile.ait = ait
+        self.reindex(profile)
 
     def update_rank(self, name, age, ):
-        for i in self.profiles:
-            if i.name == name and i.age == age:
-                print("Select new rank")
-                for rank in self.rankList:
-                    print(rank)
-                newRank = input("Enter new rank: ")
-                if newRank in self.rankList:
-                    i.rank = newRank
-                else:
-                    print("Invalid rank")
-                break
+        i = self.find_profile(name, age)
+        if i is None:
+            return
+        print("Select new rank")
+        for rank in self.rankList:
+            print(rank)
+        newRank = input("Enter new rank: ")
+        if newRank in self.rankList:
+            self.set_rank(i, newRank)
+        else:
+            print("Invalid rank")
 
     def update_ait(self, name, age):
-        for i in self.profiles:
-            if i.name == name and i.age == age:
-                print("Select new AIT")
-                for i in self.ait:
-                    print(i)
-                newAIT = input("Enter new AIT: ")
-                if newAIT in self.ait:
-                    continue
-                else:
-                    print("Invalid AIT")
-                    break
-            i.ait = newAIT
+        i = self.find_profile(name, age)
+        if i is None:
+            return
+        print("Select new AIT")
+        for ait in self.ait:
+            print(ait)
+        newAIT = input("Enter new AIT: ")
+        if newAIT in self.ait:
+            self.set_ait(i, newAIT)
+        else:
+            print("Invalid AIT")
 
     def add_demerit(self, name, age):
-        for i in self.profiles:
-            if i.name == name and i.age == age:
-                print("Add demerit")
-                demerit = input("Enter demerit: ")
-                i.demerit.append(demerit)
-                print("Demerit added")
+        i = self.find_profile(name, age)
+        if i is not None:
+            print("Add demerit")
+            demerit = input("Enter demerit: ")
+            i.demerit.append(demerit)
+            print("Demerit added")
 
 
 
@@ -636,62 +2134,59 @@ countires=["US","UK","CZ","DE","FR","RU","CA","AU","NZ","NL","BE","DK","NO","SE"
 battalion_names = ["1st Battalion", "2nd Battalion"]
 company_names = ["Easy", "Charlie", "Fox", "Dog"]
 image = "https://placehold.co/600x400"
-inc = 0
 """
 
-for award in awards:
-    db.create_award(awards[inc][0], awards[inc][1], awards[inc][2], awards[inc][3])
-    inc += 1
-print("Awards added to database")
-
-for battalion_name in battalion_names:
-    battalion = Battalion(battalion_name, db, image)
-    # Add 1-2 leaders for each battalion
-    for _ in range(random.randint(1, 2)):
-        soldier_name = names.get_full_name()
-        is_leader = 1
-        is_leader = 1
-        soldier = Profile(name=soldier_name, age=random.randint(20, 40),
-                                  address=random.choice(addresses), rank=random.choice(ranks),
-                                  ait=random.choice(aits), leadership=is_leader, country=random.choice(countires))
-
-        battalion.add_soldier(soldier)
+print("Awards:", db.sync_awards(awards))
 
-    for company_name in company_names:
-        company = Company(company_name, db, image, battalion.id)
-        # Add 1-2 leaders for each company
+with db.deferred() as batch:
+    for battalion_name in battalion_names:
+        battalion = Battalion(battalion_name, batch, image)
+        # Add 1-2 leaders for each battalion
         for _ in range(random.randint(1, 2)):
             soldier_name = names.get_full_name()
             is_leader = 1
+            is_leader = 1
             soldier = Profile(name=soldier_name, age=random.randint(20, 40),
-                              address=random.choice(addresses), rank=random.choice(ranks),
-                              ait=random.choice(aits), leadership=is_leader, country=random.choice(countires))
-            company.add_soldier(soldier)
-
-        for platoon_num in range(1, 5):  # 4 platoons per company
-            platoon_name = f"Platoon {platoon_num} of {company_name}"
-            platoon = Platoon(platoon_name, db, image, company.id)
-            # Add 1-2 leaders for each platoon
+                                      address=random.choice(addresses), rank=random.choice(ranks),
+                                      ait=random.choice(aits), leadership=is_leader, country=random.choice(countires))
+
+            battalion.add_soldier(soldier)
+
+        for company_name in company_names:
+            company = Company(company_name, batch, image, battalion.id)
+            # Add 1-2 leaders for each company
             for _ in range(random.randint(1, 2)):
                 soldier_name = names.get_full_name()
                 is_leader = 1
                 soldier = Profile(name=soldier_name, age=random.randint(20, 40),
                                   address=random.choice(addresses), rank=random.choice(ranks),
                                   ait=random.choice(aits), leadership=is_leader, country=random.choice(countires))
-                platoon.add_soldier(soldier)
-
-            for squad_num in range(1, 5):  # 4 squads per platoon
-                squad_name = f"Squad {squad_num} of {platoon_name}"
-                squad = Squad(squad_name, db, image, platoon.id)
+                company.add_soldier(soldier)
 
-                # For the sake of this example, let's assign 10 soldiers to each squad
-                for i in range(1, 11):
+            for platoon_num in range(1, 5):  # 4 platoons per company
+                platoon_name = f"Platoon {platoon_num} of {company_name}"
+                platoon = Platoon(platoon_name, batch, image, company.id)
+                # Add 1-2 leaders for each platoon
+                for _ in range(random.randint(1, 2)):
                     soldier_name = names.get_full_name()
-                    # Make the first soldier in each squad a leader
-                    is_leader = i == 1
+                    is_leader = 1
                     soldier = Profile(name=soldier_name, age=random.randint(20, 40),
                                       address=random.choice(addresses), rank=random.choice(ranks),
                                       ait=random.choice(aits), leadership=is_leader, country=random.choice(countires))
-                    squad.add_soldier(soldier)
+                    platoon.add_soldier(soldier)
+
+                for squad_num in range(1, 5):  # 4 squads per platoon
+                    squad_name = f"Squad {squad_num} of {platoon_name}"
+                    squad = Squad(squad_name, batch, image, platoon.id)
+
+                    # For the sake of this example, let's assign 10 soldiers to each squad
+                    for i in range(1, 11):
+                        soldier_name = names.get_full_name()
+                        # Make the first soldier in each squad a leader
+                        is_leader = i == 1
+                        soldier = Profile(name=soldier_name, age=random.randint(20, 40),
+                                          address=random.choice(addresses), rank=random.choice(ranks),
+                                          ait=random.choice(aits), leadership=is_leader, country=random.choice(countires))
+                        squad.add_soldier(soldier)
 
 """
\ No newline at end of file
@@ -0,0 +1,109 @@
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from awardImages import ImageStore
+from awardScraper import AWARDS_PATH, AwardInfo, Fetcher, ResponseCache, mirror_award_images, scrape_awards
+
+# Runs the scraper against a local stand-in for the 29th site that serves a
+# fixture awards page and its images with ETags, answering 304 when they match.
+
+# Only the magic bytes matter to ImageStore
+GIF = b"GIF89a" + b"\x00" * 32
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 32
+
+AWARDS_PAGE = """
+<html><body>
+<nav><a href="/x">Link</a></nav>
+<div class="media mb-4">
+  <div class="award-images mr-3"><img src="/images/medal.gif"><img src="/images/ribbon.png"></div>
+  <div class="media-body"><h5 class="mt-0">Medal of Honor</h5><p>For valor.</p></div>
+</div>
+<div class="media mb-4">
+  <div class="award-images mr-3"><img src="/images/star.gif"></div>
+  <div class="media-body"><h5 class="mt-0">Bronze Star</h5><p>For service.</p></div>
+</div>
+</body></html>
+"""
+
+PAGES = {
+    AWARDS_PATH: ("text/html", AWARDS_PAGE.encode()),
+    "/images/medal.gif": ("image/gif", GIF),
+    "/images/ribbon.png": ("image/png", PNG),
+    "/images/star.gif": ("image/gif", b"GIF87a" + b"\x01" * 32),
+}
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in PAGES:
+            self.send_error(404)
+            return
+        content_type, body = PAGES[self.path]
+        etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def site():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FixtureHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def make_fetcher(site, tmp_path):
+    return Fetcher(site, cache=ResponseCache(str(tmp_path / "cache")), workers=2, timeout=5.0)
+
+
+def test_scrape_awards_parses_records(site, tmp_path):
+    fetcher = make_fetcher(site, tmp_path)
+    awards = scrape_awards(fetcher)
+    assert awards == [
+        AwardInfo("Medal of Honor", "For valor.", "/images/medal.gif", "/images/ribbon.png"),
+        AwardInfo("Bronze Star", "For service.", "/images/star.gif", None),
+    ]
+    assert fetcher.stats == {"downloaded": 1, "not_modified": 0}
+
+
+def test_second_run_is_not_modified(site, tmp_path):
+    first = make_fetcher(site, tmp_path)
+    awards = scrape_awards(first)
+    mirror_award_images(awards, first, ImageStore(str(tmp_path / "images")))
+    assert first.stats == {"downloaded": 4, "not_modified": 0}
+
+    second = make_fetcher(site, tmp_path)
+    assert scrape_awards(second) == awards
+    mirror_award_images(awards, second, ImageStore(str(tmp_path / "images")))
+    assert second.stats == {"downloaded": 0, "not_modified": 4}
+
+
+def test_mirror_award_images_stores_images(site, tmp_path):
+    fetcher = make_fetcher(site, tmp_path)
+    store = ImageStore(str(tmp_path / "images"))
+    mirrored = mirror_award_images(scrape_awards(fetcher), fetcher, store)
+    assert set(mirrored) == {"/images/medal.gif", "/images/ribbon.png", "/images/star.gif"}
+    for url, name in mirrored.items():
+        assert store.exists(name)
+        with open(store.path(name), "rb") as f:
+            assert f.read() == PAGES[url][1]
+    assert mirrored["/images/ribbon.png"].endswith(".png")